@@ -0,0 +1,322 @@
+"""
+in-process stand-in for the parts of the kubernetes API the tools use
+
+serves, over plain HTTP on 127.0.0.1:
+
+  * selfsubjectrulesreviews / selfsubjectaccessreviews (everything allowed)
+  * GET namespaces/<name>
+  * secrets and configmaps: list (with labelSelector), create, get (also as
+    PartialObjectMetadata), replace, delete, server-side apply and
+    merge/strategic-merge patch
+
+every request sleeps `latency` (+ up to `jitter`) seconds before it is
+answered and is recorded in `calls`, so benchmarks can count requests per
+verb and resource independently of the client:
+
+    with FakeKube(namespaces=["a", "b"], latency=0.01) as kube:
+        ... point a kubeconfig at kube.url ...
+        kube.counts()   # {"GET secrets": 2, "PATCH secrets": 2, ...}
+"""
+
+import base64
+import copy
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+OBJECT_PATH = re.compile(
+    r"^/api/v1/namespaces/(?P<namespace>[^/]+)"
+    r"(?:/(?P<resource>secrets|configmaps)(?:/(?P<name>[^/]+))?)?$"
+)
+
+REVIEW_PATH = re.compile(
+    r"^/apis/authorization\.k8s\.io/v1/(?P<review>selfsubject(?:rules|access)reviews)$"
+)
+
+KINDS = {"secrets": "Secret", "configmaps": "ConfigMap"}
+
+
+def merge_patch(target, patch):
+    """
+    RFC 7386 JSON merge patch of _patch_ into _target_ (in place)
+    """
+
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_patch(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+    return target
+
+
+def status(code, reason):
+
+    return code, {"kind": "Status", "apiVersion": "v1", "status": "Failure",
+                  "reason": reason, "code": code}
+
+
+class FakeKube(object):
+    """
+    namespaces: names of the namespaces that exist
+    latency: (float) seconds added to every request
+    jitter: (float) up to this many more seconds, uniformly distributed
+    """
+
+    def __init__(self, namespaces=("default",), latency=0.0, jitter=0.0):
+        self.namespaces = set(namespaces)
+        self.latency = latency
+        self.jitter = jitter
+        self.objects = dict()
+        self.calls = []
+        self.url = None
+        self._lock = threading.Lock()
+        self._version = 0
+        self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """
+        return: (str) base URL of the server
+        """
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+        self.url = "http://127.0.0.1:{}".format(self._server.server_address[1])
+
+        return self.url
+
+    def stop(self):
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def reset_calls(self):
+
+        with self._lock:
+            self.calls = []
+
+    def counts(self):
+        """
+        return: dict of {"<METHOD> <resource>": requests}
+        """
+
+        retval = dict()
+
+        with self._lock:
+            for call in self.calls:
+                key = "{} {}".format(call["method"], call["resource"])
+                retval[key] = retval.get(key, 0) + 1
+
+        return dict(sorted(retval.items()))
+
+    def kubeconfig(self, name, namespace="default"):
+        """
+        return: kubeconfig dict with a context, _name_, pointing at this server
+        """
+
+        return {
+            "apiVersion": "v1",
+            "kind": "Config",
+            "clusters": [{"name": name, "cluster": {"server": self.url}}],
+            "users": [{"name": name, "user": {"token": "fake"}}],
+            "contexts": [{
+                "name": name,
+                "context": {"cluster": name, "user": name, "namespace": namespace},
+            }],
+            "current-context": name,
+        }
+
+    # request handling
+
+    def _record(self, method, path, resource, sent):
+
+        with self._lock:
+            self.calls.append({
+                "method": method,
+                "path": path,
+                "resource": resource,
+                "sent": sent,
+                "time": time.time(),
+            })
+
+    def _next_version(self, obj):
+
+        self._version += 1
+        obj.setdefault("metadata", dict())["resourceVersion"] = str(self._version)
+
+        return obj
+
+    def handle(self, method, url, headers, body):
+        """
+        return: tuple(status code, response document)
+        """
+
+        path = urlparse(url).path
+        query = parse_qs(urlparse(url).query)
+
+        review = REVIEW_PATH.match(path)
+        match = OBJECT_PATH.match(path)
+
+        self._record(
+            method, path,
+            review.group("review") if review else
+            (match.group("resource") or "namespaces") if match else path,
+            len(body),
+        )
+
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if review:
+            doc = json.loads(body)
+
+            if review.group("review") == "selfsubjectrulesreviews":
+                doc["status"] = {
+                    "incomplete": False,
+                    "nonResourceRules": [],
+                    "resourceRules": [{
+                        "verbs": ["*"], "apiGroups": [""], "resources": ["*"],
+                    }],
+                }
+            else:
+                doc["status"] = {"allowed": True}
+
+            return 201, doc
+
+        if not match or match.group("namespace") not in self.namespaces:
+            return status(404, "NotFound")
+
+        namespace, resource, name = match.group("namespace", "resource", "name")
+
+        if resource is None:
+            return 200, {"kind": "Namespace", "apiVersion": "v1",
+                         "metadata": {"name": namespace}}
+
+        with self._lock:
+            if name is None:
+                return self._collection(method, namespace, resource, query, body)
+
+            return self._item(method, namespace, resource, name, headers, body)
+
+    def _collection(self, method, namespace, resource, query, body):
+
+        if method == "GET":
+            selector = dict(
+                el.split("=", 1)
+                for el in (query.get("labelSelector") or [""])[0].split(",") if el
+            )
+
+            return 200, {
+                "kind": "{}List".format(KINDS[resource]),
+                "apiVersion": "v1",
+                "metadata": {"resourceVersion": str(self._version)},
+                "items": [
+                    obj for key, obj in sorted(self.objects.items())
+                    if key[:2] == (namespace, resource) and all(
+                        (obj["metadata"].get("labels") or dict()).get(k) == v
+                        for k, v in selector.items()
+                    )
+                ],
+            }
+
+        if method == "POST":
+            obj = json.loads(body)
+            key = (namespace, resource, obj["metadata"]["name"])
+
+            if key in self.objects:
+                return status(409, "AlreadyExists")
+
+            self.objects[key] = self._next_version(obj)
+
+            return 201, obj
+
+        return status(405, "MethodNotAllowed")
+
+    def _item(self, method, namespace, resource, name, headers, body):
+
+        key = (namespace, resource, name)
+        current = self.objects.get(key)
+
+        if method == "PATCH" and headers.get("Content-Type", "").startswith("application/apply-patch"):
+            obj = json.loads(body)
+
+            if "stringData" in obj:
+                obj.setdefault("data", dict()).update({
+                    k: base64.b64encode(v.encode("utf-8")).decode("ascii")
+                    for k, v in obj.pop("stringData").items()
+                })
+
+            obj["metadata"]["name"] = name
+            self.objects[key] = self._next_version(obj)
+
+            return (200 if current else 201), obj
+
+        if current is None:
+            return status(404, "NotFound")
+
+        if method == "GET":
+            if "as=PartialObjectMetadata" in headers.get("Accept", ""):
+                return 200, {"kind": "PartialObjectMetadata", "apiVersion": "meta.k8s.io/v1",
+                             "metadata": current["metadata"]}
+
+            return 200, current
+
+        if method == "PUT":
+            self.objects[key] = self._next_version(json.loads(body))
+
+            return 200, self.objects[key]
+
+        if method == "PATCH":
+            self.objects[key] = self._next_version(merge_patch(copy.deepcopy(current), json.loads(body)))
+
+            return 200, self.objects[key]
+
+        if method == "DELETE":
+            del self.objects[key]
+
+            return 200, {"kind": "Status", "apiVersion": "v1", "status": "Success"}
+
+        return status(405, "MethodNotAllowed")
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+            def _dispatch(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+
+                code, doc = server.handle(self.command, self.path, self.headers, body)
+                payload = json.dumps(doc).encode("utf-8")
+
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+        return Handler
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+"""
+kubernetes write benchmarks: sync-to-eks and mkeksauth --apply
+
+AWS is a threaded moto server (EKS, SSM, KMS, IAM, STS); every cluster is a
+FakeKube (see fakekube.py) with --namespaces namespaces and --latency
+seconds added to each request.  moto's DescribeCluster endpoint for each
+cluster is pointed at its FakeKube, so the tools run unmodified, as
+subprocesses with AWS_ENDPOINT_URL set, and with --trace-api.
+
+scenarios:
+
+  sync-to-eks create      first write of the component secret to every
+                          cluster/namespace
+  sync-to-eks unchanged   same parameters again (content hash matches)
+  sync-to-eks update      after one parameter has changed
+  sync-to-eks watch       --watch for two polls, after another parameter
+                          has changed
+  mkeksauth create        --apply to every cluster, one process per cluster
+  mkeksauth replace       the same again, replacing aws-auth
+
+each scenario reports its wall time, kubernetes requests per verb and
+resource (counted by the fake servers) and AWS calls (from --trace-api).
+results go to --output (JSON) and can be compared with an earlier run:
+
+    python benchmarks/kube_writes.py --clusters 3 --namespaces 10 --latency 0.02
+    python benchmarks/kube_writes.py --compare benchmarks/results/kube-<rev>.json
+"""
+
+import base64
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+from fakekube import FakeKube
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+ENTRY_POINTS = {
+    "env-kube-sps": (os.path.join(ROOT, "env-kube-sps"), "env_kube_sps", "run"),
+    "mkeksauth": (os.path.join(ROOT, "mkeksauth"), "src.mkeksauth", "cli"),
+}
+
+ACCOUNT = "123456789012"
+REGION = "us-east-1"
+ENVIRONMENT = "bench"
+COMPONENT = "api"
+
+# two --watch polls a second apart: the first pushes the changed parameter,
+# the second finds nothing to do
+WATCH_ARGS = ["--watch", "--interval", "1", "--iterations", "2"]
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def trace_summary(stderr):
+    """
+    return: the --trace-api JSON summary at the end of _stderr_
+    """
+
+    return json.loads(stderr[stderr.rfind("\n{\n") + 1:])
+
+
+def run(entry, argv, env):
+    """
+    run _entry_ from source with _argv_
+
+    return: tuple(seconds, --trace-api summary)
+    """
+
+    path, module, func = ENTRY_POINTS[entry]
+
+    code = "import sys; sys.argv[0] = {!r}; from {} import {} as main; main()".format(
+        entry, module, func
+    )
+
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", code] + argv,
+        env=dict(env, PYTHONPATH=path),
+        input="",
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    elapsed = time.perf_counter() - start
+
+    if proc.returncode:
+        raise click.ClickException("{} {}: exit {}\n{}".format(
+            entry, " ".join(argv), proc.returncode, proc.stderr[-2000:]
+        ))
+
+    return elapsed, trace_summary(proc.stderr)
+
+
+class Bench(object):
+    """
+    moto server, one FakeKube per cluster and the environment the tools run in
+    """
+
+    def __init__(self, clusters, namespaces, latency, jitter, keys):
+        self.names = ["bench-{:02d}".format(i) for i in range(clusters)]
+        self.namespaces = ["ns-{:03d}".format(i) for i in range(namespaces)]
+        self.keys = keys
+        self.kubes = {
+            name: FakeKube(namespaces=self.namespaces + ["kube-system"],
+                           latency=latency, jitter=jitter)
+            for name in self.names
+        }
+        self.tmp = tempfile.TemporaryDirectory(prefix="kube-bench-")
+        self.env = None
+        self._moto = None
+
+    def __enter__(self):
+        from moto.server import ThreadedMotoServer
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+        self._moto = ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+        self._moto.start()
+        host, port = self._moto.get_host_and_port()
+
+        self.env = dict(
+            os.environ,
+            AWS_ENDPOINT_URL="http://{}:{}".format(host, port),
+            AWS_DEFAULT_REGION=REGION,
+            AWS_ACCESS_KEY_ID="bench",
+            AWS_SECRET_ACCESS_KEY="bench",
+            XDG_CACHE_HOME=self.tmp.name,
+            KUBECONFIG=os.path.join(self.tmp.name, "kubeconfig"),
+        )
+
+        for kube in self.kubes.values():
+            kube.start()
+
+        self.seed()
+
+        return self
+
+    def __exit__(self, *exc):
+
+        for kube in self.kubes.values():
+            kube.stop()
+
+        self._moto.stop()
+        self.tmp.cleanup()
+
+    def client(self, service):
+        import boto3
+
+        return boto3.client(
+            service,
+            endpoint_url=self.env["AWS_ENDPOINT_URL"],
+            region_name=REGION,
+            aws_access_key_id="bench",
+            aws_secret_access_key="bench",
+        )
+
+    def seed(self):
+        from moto.eks.models import eks_backends
+
+        kms = self.client("kms")
+        kms.create_alias(
+            AliasName="alias/{}/ssm".format(ENVIRONMENT),
+            TargetKeyId=kms.create_key()["KeyMetadata"]["KeyId"],
+        )
+
+        for i in range(self.keys):
+            self.put_parameter("KEY_{:04d}".format(i), "value-{}".format(i))
+
+        iam = self.client("iam")
+        role_arn = iam.create_role(
+            RoleName="bench-admin", AssumeRolePolicyDocument="{}"
+        )["Role"]["Arn"]
+
+        eks = self.client("eks")
+        contexts = []
+
+        for name, kube in self.kubes.items():
+            eks.create_cluster(name=name, roleArn=role_arn, resourcesVpcConfig={})
+
+            cluster = eks_backends[ACCOUNT][REGION].clusters[name]
+            cluster.endpoint = kube.url
+            cluster.certificate_authority = {
+                "data": base64.b64encode(b"fake").decode("ascii")
+            }
+
+            contexts.append(kube.kubeconfig(name, namespace="kube-system"))
+
+        with open(self.env["KUBECONFIG"], "w") as fh:
+            json.dump({
+                "apiVersion": "v1",
+                "kind": "Config",
+                "clusters": [el["clusters"][0] for el in contexts],
+                "users": [el["users"][0] for el in contexts],
+                "contexts": [el["contexts"][0] for el in contexts],
+                "current-context": self.names[0],
+            }, fh)
+
+    def put_parameter(self, key, value):
+        ssm = self.client("ssm")
+        name = "/{}/{}/{}".format(ENVIRONMENT, COMPONENT, key)
+
+        version = ssm.put_parameter(
+            Name=name, Value=value, Type="SecureString", Overwrite=True,
+            KeyId="alias/{}/ssm".format(ENVIRONMENT),
+        )["Version"]
+        ssm.label_parameter_version(Name=name, ParameterVersion=version, Labels=["staged"])
+
+    def measure(self, runs):
+        """
+        runs: list of tuple(entry, argv)
+
+        return: dict of results for the scenario
+        """
+
+        for kube in self.kubes.values():
+            kube.reset_calls()
+
+        seconds = 0.0
+        aws = dict()
+        kube_seconds = 0.0
+
+        for entry, argv in runs:
+            elapsed, summary = run(entry, argv, self.env)
+            seconds += elapsed
+
+            for name, operation in summary["operations"].items():
+                if operation["api"] == "aws":
+                    aws[name] = aws.get(name, 0) + operation["calls"]
+                else:
+                    kube_seconds += operation["seconds"]
+
+        kube_calls = dict()
+
+        for kube in self.kubes.values():
+            for name, count in kube.counts().items():
+                kube_calls[name] = kube_calls.get(name, 0) + count
+
+        return {
+            "seconds": round(seconds, 4),
+            "calls": sum(kube_calls.values()) + sum(aws.values()),
+            "kube": dict(sorted(kube_calls.items())),
+            "kube_seconds": round(kube_seconds, 4),
+            "aws": dict(sorted(aws.items())),
+        }
+
+
+def sync_to_eks(bench, layout, concurrency, extra=()):
+
+    return ("env-kube-sps", [
+        "--environment", ENVIRONMENT, "--component", COMPONENT,
+        "--max-concurrency", str(concurrency), "--trace-api",
+        "sync-to-eks", "--layout", layout,
+    ] + list(extra) + [
+        arg for name in bench.names for arg in ("-c", name)
+    ] + [
+        arg for namespace in bench.namespaces for arg in ("-n", namespace)
+    ])
+
+
+def mkeksauth(bench):
+
+    return [
+        ("mkeksauth", [
+            "--cluster-name", name, "--context", name,
+            "--role", "bench-admin", "system:masters",
+            "--output-file", os.path.join(bench.tmp.name, "{}.yaml".format(name)),
+            "--apply", "--trace-api",
+        ])
+        for name in bench.names
+    ]
+
+
+def compare(previous, current):
+    for scenario, result in current["scenarios"].items():
+        before = previous.get("scenarios", {}).get(scenario)
+
+        if not before:
+            continue
+
+        delta = result["seconds"] - before["seconds"]
+        calls = result["calls"] - before["calls"]
+
+        click.secho(
+            "{:<22} {:>9.3f}s -> {:>9.3f}s ({:+.1%})  calls {:+d}".format(
+                scenario, before["seconds"], result["seconds"],
+                delta / before["seconds"] if before["seconds"] else 0, calls,
+            ),
+            fg="red" if delta > 0.1 * before["seconds"] or calls > 0 else "green",
+        )
+
+
+@click.command()
+@click.option("--clusters", type=click.IntRange(min=1), default=3, show_default=True)
+@click.option("--namespaces", type=click.IntRange(min=1), default=10, show_default=True,
+              help="namespaces per cluster, all targeted by sync-to-eks")
+@click.option("--latency", type=float, default=0.02, show_default=True,
+              help="seconds added to every kubernetes request")
+@click.option("--jitter", type=float, default=0.0, show_default=True,
+              help="up to this many more seconds per request")
+@click.option("--keys", type=click.IntRange(min=1), default=50, show_default=True,
+              help="parameters in the component")
+@click.option("--layout", type=click.Choice(["env", "keys"]), default="env", show_default=True)
+@click.option("--max-concurrency", "concurrency", type=click.IntRange(min=1), default=8,
+              show_default=True)
+@click.option("-o", "--output", type=click.Path(dir_okay=False), default=None,
+              help="results file (default: benchmarks/results/kube-<git rev>.json)")
+@click.option("--compare", "compare_with", type=click.File("r"), default=None,
+              help="earlier results file to compare with")
+def main(clusters, namespaces, latency, jitter, keys, layout, concurrency, output, compare_with):
+    try:
+        import moto.server  # noqa: F401  pylint: disable=unused-import
+    except ImportError:
+        raise click.ClickException("moto's server is required: pip install 'moto[server]'")
+
+    results = {
+        "revision": revision(),
+        "python": sys.version.split()[0],
+        "clusters": clusters,
+        "namespaces": namespaces,
+        "latency": latency,
+        "jitter": jitter,
+        "keys": keys,
+        "layout": layout,
+        "max_concurrency": concurrency,
+        "scenarios": {},
+    }
+
+    with Bench(clusters, namespaces, latency, jitter, keys) as bench:
+        scenarios = [
+            ("sync-to-eks create", lambda: [sync_to_eks(bench, layout, concurrency)]),
+            ("sync-to-eks unchanged", lambda: [sync_to_eks(bench, layout, concurrency)]),
+            ("sync-to-eks update", lambda: bench.put_parameter("KEY_0000", "changed") or [
+                sync_to_eks(bench, layout, concurrency)
+            ]),
+            ("sync-to-eks watch", lambda: bench.put_parameter("KEY_0001", "changed") or [
+                sync_to_eks(bench, layout, concurrency, WATCH_ARGS)
+            ]),
+            ("mkeksauth create", lambda: mkeksauth(bench)),
+            ("mkeksauth replace", lambda: mkeksauth(bench)),
+        ]
+
+        click.secho("{} clusters x {} namespaces, {:.0f}ms per kubernetes request".format(
+            clusters, namespaces, latency * 1000
+        ), bold=True, err=True)
+
+        for scenario, runs in scenarios:
+            result = results["scenarios"][scenario] = bench.measure(runs())
+
+            click.echo("  {:<22} {:>8.3f}s  {}".format(
+                scenario, result["seconds"],
+                " ".join("{}={}".format(k, v) for k, v in result["kube"].items()),
+            ), err=True)
+
+    output = output or os.path.join(RESULTS, "kube-{}.json".format(results["revision"]))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    with open(output, "w") as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+        fh.write("\n")
+
+    click.echo("results written to {}".format(output), err=True)
+
+    if compare_with:
+        compare(json.load(compare_with), results)
+
+
+if __name__ == "__main__":
+    main()
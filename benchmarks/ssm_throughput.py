@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""
+throughput benchmarks for the env-kube-sps SSM paths, against moto
+
+for each prefix size (100, 1k and 10k keys by default) a fresh in-process
+moto SSM/KMS is seeded with parameters carrying --history versions each,
+with `staged` on the newest version and `previous` on the one before.
+then, end to end and with --trace-api:
+
+  list-sps              DescribeParameters walk
+  parameters_by_label   `staged` (label filter + GetParameters)
+  list-labels           --label staged, checked again after `staged` is
+                        moved to an earlier version of one key
+  sync-to-sps --update  every key re-sent, --changed of them with new values
+  purge-sps             every key
+
+each operation's wall time and API calls (per AWS operation) are recorded.
+results go to --output (JSON) and can be compared with an earlier run:
+
+    python benchmarks/ssm_throughput.py --sizes 100,1000
+    python benchmarks/ssm_throughput.py --compare benchmarks/results/ssm-<rev>.json
+
+moto answers in-process, so the timings measure env-kube-sps itself
+(request building, pagination, concurrency, rate limiting) rather than
+AWS latency.  --tps lifts the PutParameter/DeleteParameters rate limits
+to keep AWS's throughput quotas out of the numbers.
+"""
+
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.join(ROOT, "env-kube-sps"))
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+ENVIRONMENT = "bench"
+
+for key, value in (
+    ("AWS_DEFAULT_REGION", "us-east-1"),
+    ("AWS_ACCESS_KEY_ID", "bench"),
+    ("AWS_SECRET_ACCESS_KEY", "bench"),
+):
+    os.environ.setdefault(key, value)
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def seed(ssm, component, size, history):
+    prefix = "/{}/{}".format(ENVIRONMENT, component)
+
+    for i in range(size):
+        name = "{}/KEY_{:05d}".format(prefix, i)
+
+        for version in range(1, history + 1):
+            ssm.put_parameter(
+                Name=name,
+                Value="value-{}-{}".format(i, version),
+                Type="SecureString",
+                KeyId="alias/{}/ssm".format(ENVIRONMENT),
+                Overwrite=version > 1,
+            )
+
+        if history > 1:
+            ssm.label_parameter_version(Name=name, ParameterVersion=history - 1, Labels=["previous"])
+
+        ssm.label_parameter_version(Name=name, ParameterVersion=history, Labels=["staged"])
+
+
+def trace_summary(stderr):
+    """
+    return: the --trace-api JSON summary at the end of _stderr_
+    """
+
+    return json.loads(stderr[stderr.rfind("\n{\n") + 1:])
+
+
+def api_calls(summary):
+
+    return {
+        name: entry["calls"]
+        for name, entry in sorted(summary["operations"].items())
+    }
+
+
+def invoke(main, component, args, concurrency, stdin=None, output=None):
+    """
+    output: list receiving the command's output lines (stderr, ahead of
+      the --trace-api summary)
+    """
+
+    from click.testing import CliRunner
+
+    runner = CliRunner(mix_stderr=False)
+
+    start = time.perf_counter()
+    res = runner.invoke(
+        main,
+        [
+            "--environment", ENVIRONMENT, "--component", component,
+            "--max-concurrency", str(concurrency), "--trace-api",
+        ] + args,
+        input=stdin,
+        catch_exceptions=False,
+    )
+    elapsed = time.perf_counter() - start
+
+    if res.exit_code:
+        raise click.ClickException("{}: exit {}\n{}".format(
+            " ".join(args), res.exit_code, res.stderr[-2000:]
+        ))
+
+    summary = trace_summary(res.stderr)
+
+    if output is not None:
+        output.extend(res.stderr[:res.stderr.rfind("\n{\n") + 1].splitlines())
+
+    return {
+        "seconds": round(elapsed, 4),
+        "calls": summary["calls"],
+        "throttles": summary["throttles"],
+        "api": api_calls(summary),
+    }
+
+
+def parameters_by_label(main, component, concurrency):
+    """
+    sps.parameters_by_label() inside a CLI context, traced like a command
+    """
+
+    import env_kube_sps.apitrace as apitrace
+    import env_kube_sps.sps as sps
+
+    ctx = main.make_context("env-kube-sps", [
+        "--environment", ENVIRONMENT, "--component", component,
+        "--max-concurrency", str(concurrency), "list-sps",
+    ])
+
+    with ctx:
+        ctx.invoke(main.callback, **ctx.params)
+        ctx.obj.trace = ctx.obj.clients.trace = apitrace.ApiTrace()
+
+        start = time.perf_counter()
+
+        with ctx.scope(cleanup=False):
+            found = sps.parameters_by_label(["staged"])
+
+        elapsed = time.perf_counter() - start
+
+        summary = ctx.obj.trace.summary()
+
+    return {
+        "seconds": round(elapsed, 4),
+        "calls": summary["calls"],
+        "throttles": summary["throttles"],
+        "api": api_calls(summary),
+        "found": len(found),
+    }
+
+
+def label_move(main, ssm, component, concurrency):
+    """
+    list-labels --label staged, then again after `staged` is moved back
+    to the previous version of one key.  moving a label changes no
+    parameter metadata, so this checks the answer is not served stale
+    from the (--cache) label index
+
+    return: results of the first run
+    """
+
+    name = "/{}/{}/KEY_00000".format(ENVIRONMENT, component)
+    version = ssm.get_parameter(Name="{}:staged".format(name))["Parameter"]["Version"]
+
+    with tempfile.TemporaryDirectory(prefix="ssm-bench-") as cache_dir:
+        args = ["--cache", "--cache-dir", cache_dir, "list-labels", "--label", "staged"]
+        output = []
+
+        result = invoke(main, component, args, concurrency, output=output)
+
+        if "{}:{}".format(name, version) not in output:
+            raise click.ClickException("list-labels: {}:{} missing".format(name, version))
+
+        if version > 1:
+            ssm.label_parameter_version(Name=name, ParameterVersion=version - 1, Labels=["staged"])
+
+            output = []
+            invoke(main, component, args, concurrency, output=output)
+
+            if "{}:{}".format(name, version - 1) not in output:
+                raise click.ClickException(
+                    "list-labels: stale after moving staged to {}:{}".format(name, version - 1)
+                )
+
+    return result
+
+
+def run_size(size, history, changed, concurrency, tps):
+    import boto3
+    from moto import mock_aws
+
+    from env_kube_sps.main import main
+
+    component = "svc-{}".format(size)
+    results = {}
+
+    with mock_aws():
+        kms = boto3.client("kms")
+        kms.create_alias(
+            AliasName="alias/{}/ssm".format(ENVIRONMENT),
+            TargetKeyId=kms.create_key()["KeyMetadata"]["KeyId"],
+        )
+
+        start = time.perf_counter()
+        seed(boto3.client("ssm"), component, size, history)
+        results["seed"] = {"seconds": round(time.perf_counter() - start, 4)}
+
+        results["list-sps"] = invoke(main, component, ["list-sps", "--no-sort"], concurrency)
+
+        results["parameters_by_label"] = parameters_by_label(main, component, concurrency)
+
+        results["list-labels"] = label_move(main, boto3.client("ssm"), component, concurrency)
+
+        env_file = io.StringIO()
+        for i in range(size):
+            env_file.write("KEY_{:05d}={}\n".format(
+                i, "changed-{}".format(i) if i < changed * size else "value-{}-{}".format(i, history)
+            ))
+
+        with tempfile.NamedTemporaryFile("w", suffix=".env", delete=False) as fh:
+            fh.write(env_file.getvalue())
+
+        try:
+            results["sync-to-sps"] = invoke(main, component, [
+                "sync-to-sps", "--update", "--input-file", fh.name, "--tps", str(tps),
+            ], concurrency)
+        finally:
+            os.remove(fh.name)
+
+        results["purge-sps"] = invoke(main, component, [
+            "purge-sps", "--yes", "--regex", ".*", "--tps", str(tps),
+        ], concurrency)
+
+    return results
+
+
+def compare(previous, current):
+    for size, operations in sorted(current["sizes"].items(), key=lambda el: int(el[0])):
+        for operation, result in operations.items():
+            before = previous.get("sizes", {}).get(size, {}).get(operation)
+
+            if not before:
+                continue
+
+            delta = result["seconds"] - before["seconds"]
+            calls = result.get("calls", 0) - before.get("calls", 0)
+
+            click.secho(
+                "{:>6} {:<20} {:>9.3f}s -> {:>9.3f}s ({:+.1%})  calls {:+d}".format(
+                    size, operation, before["seconds"], result["seconds"],
+                    delta / before["seconds"] if before["seconds"] else 0, calls,
+                ),
+                fg="red" if delta > 0.1 * before["seconds"] or calls > 0 else "green",
+            )
+
+
+@click.command()
+@click.option("--sizes", default="100,1000,10000", show_default=True,
+              help="comma separated prefix sizes (keys)")
+@click.option("--history", type=click.IntRange(min=1), default=5, show_default=True,
+              help="versions per parameter")
+@click.option("--changed", type=click.FloatRange(0, 1), default=0.1, show_default=True,
+              help="fraction of keys sync-to-sps changes")
+@click.option("--max-concurrency", "concurrency", type=click.IntRange(min=1), default=8,
+              show_default=True)
+@click.option("--tps", type=float, default=10000, show_default=True,
+              help="--tps for sync-to-sps and purge-sps")
+@click.option("-o", "--output", type=click.Path(dir_okay=False), default=None,
+              help="results file (default: benchmarks/results/ssm-<git rev>.json)")
+@click.option("--compare", "compare_with", type=click.File("r"), default=None,
+              help="earlier results file to compare with")
+def main(sizes, history, changed, concurrency, tps, output, compare_with):
+    try:
+        import moto  # noqa: F401  pylint: disable=unused-import
+    except ImportError:
+        raise click.ClickException("moto is required: pip install 'moto[ssm,kms]'")
+
+    results = {
+        "revision": revision(),
+        "python": sys.version.split()[0],
+        "history": history,
+        "changed": changed,
+        "max_concurrency": concurrency,
+        "tps": tps,
+        "sizes": {},
+    }
+
+    for size in [int(el) for el in sizes.split(",") if el]:
+        click.secho("{} keys x {} versions".format(size, history), bold=True, err=True)
+
+        results["sizes"][str(size)] = run_size(size, history, changed, concurrency, tps)
+
+        for operation, result in results["sizes"][str(size)].items():
+            click.echo("  {:<20} {:>9.3f}s  {}".format(
+                operation, result["seconds"],
+                " ".join("{}={}".format(k, v) for k, v in result.get("api", {}).items()),
+            ), err=True)
+
+    output = output or os.path.join(RESULTS, "ssm-{}.json".format(results["revision"]))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    with open(output, "w") as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+        fh.write("\n")
+
+    click.echo("results written to {}".format(output), err=True)
+
+    if compare_with:
+        compare(json.load(compare_with), results)
+
+
+if __name__ == "__main__":
+    main()
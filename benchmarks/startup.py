@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+cold-start benchmarks for the env-kube-sps, mkeksauth and kmbs entry points
+
+each case runs its entry point in a fresh interpreter (sources are used
+straight from the tree; nothing needs to be installed) and records the
+median wall time.  a single `-X importtime` run per case attributes the
+import cost to top-level packages (summed self time) and checks that modules a case must not
+load (e.g.: kubernetes for `env-kube-sps list-sps`) stay out.
+
+    python benchmarks/startup.py                    # compare with the baseline
+    python benchmarks/startup.py --update-baseline  # record a new baseline
+
+exits 1 when a case is slower than its baseline by more than --tolerance
+(and --slack seconds), exceeds its absolute budget or loads a forbidden
+module.
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup-baseline.json")
+
+ENTRY_POINTS = {
+    "env-kube-sps": (os.path.join(ROOT, "env-kube-sps"), "env_kube_sps", "run"),
+    "mkeksauth": (os.path.join(ROOT, "mkeksauth"), "src.mkeksauth", "cli"),
+    "kmbs": (os.path.join(ROOT, "manifest-bundle-splitter"), "ysplit", "run"),
+}
+
+BUNDLE = """\
+apiVersion: v1
+kind: Namespace
+metadata:
+  name: bench
+---
+apiVersion: v1
+kind: ConfigMap
+metadata:
+  name: bench
+  namespace: bench
+data:
+  key: value
+"""
+
+EKS_ARGS = ["--environment", "bench", "--component", "startup"]
+
+# name: (entry point, argv, stdin, modules that must not be imported,
+#        absolute budget in seconds)
+CASES = {
+    "env-kube-sps --help": (
+        "env-kube-sps", ["--help"], None, ("kubernetes", "boto3"), 0.5
+    ),
+    "env-kube-sps list-sps --help": (
+        "env-kube-sps", EKS_ARGS + ["list-sps", "--help"], None, ("kubernetes", "boto3"), 0.5
+    ),
+    "env-kube-sps invalidate-cache": (
+        "env-kube-sps", EKS_ARGS + ["--cache-dir", "{tmp}", "invalidate-cache"], None,
+        ("kubernetes",), 1.0
+    ),
+    "env-kube-sps sync-to-eks --help": (
+        "env-kube-sps", EKS_ARGS + ["sync-to-eks", "--help"], None, (), 2.0
+    ),
+    "mkeksauth --help": (
+        "mkeksauth", ["--help"], None, (), 2.0
+    ),
+    "mkeksauth list-aws-roles --help": (
+        "mkeksauth", ["list-aws-roles", "--help"], "", (), 2.0
+    ),
+    "kmbs --help": (
+        "kmbs", ["--help"], None, (), 0.5
+    ),
+    "kmbs split": (
+        "kmbs", ["-o", "{tmp}"], BUNDLE, (), 0.5
+    ),
+}
+
+
+def command(case, tmp, importtime=False):
+    entry, argv, _, _, _ = CASES[case]
+    path, module, func = ENTRY_POINTS[entry]
+
+    code = "import sys; sys.argv[0] = {!r}; from {} import {} as main; main()".format(
+        entry, module, func
+    )
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [path] + [el for el in [os.environ.get("PYTHONPATH")] if el]
+    ))
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    args = [sys.executable] + (["-X", "importtime"] if importtime else [])
+    args += ["-c", code] + [el.format(tmp=tmp) for el in argv]
+
+    return args, env, path
+
+
+def run_once(case, tmp, importtime=False):
+    args, env, cwd = command(case, tmp, importtime)
+    stdin = CASES[case][2]
+
+    start = time.perf_counter()
+    res = subprocess.run(
+        args,
+        env=env,
+        cwd=cwd,
+        input=(stdin or "").encode("utf-8"),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    elapsed = time.perf_counter() - start
+
+    if res.returncode:
+        raise click.ClickException("{}: exit {}\n{}".format(
+            case, res.returncode, res.stderr.decode("utf-8", "replace")[-2000:]
+        ))
+
+    return elapsed, res.stderr.decode("utf-8", "replace")
+
+
+def import_profile(stderr):
+    """
+    return: dict of {top-level package: microseconds} summing the self time
+      of every module imported under that package
+    """
+
+    retval = dict()
+
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        self_time, _, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+
+        retval[package] = retval.get(package, 0) + int(self_time)
+
+    return retval
+
+
+def measure(case, runs):
+    tmp = tempfile.mkdtemp(prefix="startup-bench-")
+
+    samples = [run_once(case, tmp)[0] for _ in range(runs)]
+    _, stderr = run_once(case, tmp, importtime=True)
+
+    profile = import_profile(stderr)
+    loaded = {
+        line.rsplit("|", 1)[-1].strip()
+        for line in stderr.splitlines()
+        if line.startswith("import time:")
+    }
+
+    return {
+        "median": round(statistics.median(samples), 4),
+        "min": round(min(samples), 4),
+        "imports": dict(sorted(profile.items(), key=lambda el: -el[1])[:8]),
+        "forbidden": sorted(
+            el for el in CASES[case][3] if el in loaded
+        ),
+    }
+
+
+@click.command()
+@click.option("-n", "--runs", type=click.IntRange(min=1), default=5, show_default=True)
+@click.option("-k", "--case", "cases", multiple=True, type=click.Choice(sorted(CASES)),
+              help="run only these cases")
+@click.option("--tolerance", type=float, default=0.25, show_default=True,
+              help="allowed slowdown over the baseline (fraction)")
+@click.option("--slack", type=float, default=0.05, show_default=True,
+              help="seconds of noise allowed on top of --tolerance")
+@click.option("--update-baseline", is_flag=True, default=False)
+@click.option("--json", "json_out", type=click.File("w"), default=None,
+              help="also write the results here")
+def main(runs, cases, tolerance, slack, update_baseline, json_out):
+    try:
+        with open(BASELINE) as fh:
+            baseline = json.load(fh)
+    except FileNotFoundError:
+        baseline = dict()
+
+    results = dict()
+    failures = []
+
+    for case in cases or sorted(CASES):
+        result = results[case] = measure(case, runs)
+        budget = CASES[case][4]
+        base = baseline.get(case, {}).get("median")
+
+        status = []
+
+        if result["forbidden"]:
+            status.append("imports {}".format(", ".join(result["forbidden"])))
+
+        if result["median"] > budget:
+            status.append("over budget ({:.3f}s)".format(budget))
+
+        if base and not update_baseline and result["median"] > base * (1 + tolerance) + slack:
+            status.append("regressed from {:.3f}s".format(base))
+
+        if status:
+            failures.append(case)
+
+        click.secho(
+            "{:<36} {:>7.3f}s median {:>7.3f}s min  {}".format(
+                case, result["median"], result["min"],
+                "; ".join(status) or ("baseline {:.3f}s".format(base) if base else "")
+            ),
+            fg="red" if status else "green",
+        )
+
+        for module, usec in result["imports"].items():
+            click.echo("    {:<32} {:>7.1f}ms".format(module, usec / 1000.0))
+
+    if json_out:
+        json.dump(results, json_out, indent=2, sort_keys=True)
+
+    if update_baseline:
+        baseline.update({
+            case: {"median": result["median"], "min": result["min"]}
+            for case, result in results.items()
+        })
+        baseline["_python"] = sys.version.split()[0]
+
+        with open(BASELINE, "w") as fh:
+            json.dump(baseline, fh, indent=2, sort_keys=True)
+            fh.write("\n")
+
+        click.echo("baseline written to {}".format(BASELINE))
+
+    if failures:
+        raise click.ClickException("{} case(s) failed: {}".format(
+            len(failures), ", ".join(failures)
+        ))
+
+
+if __name__ == "__main__":
+    main()
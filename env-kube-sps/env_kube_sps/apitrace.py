@@ -0,0 +1,271 @@
+'''
+per-API-call tracing (`--trace-api`)
+
+botocore calls are timed through the session's before-call/after-call
+events (needs-retry counts retries and throttles); kubernetes calls by
+wrapping the ApiClient of each cluster.  every call is attributed to the
+_phase_ active in the calling thread (see phase()); concurrent_map carries
+the phase into its workers.
+'''
+
+import contextlib
+import functools
+import json
+import threading
+import time
+
+import click
+
+from .util import THROTTLE_ERROR_CODES
+
+
+_local = threading.local()
+
+
+def current_phase():
+
+    return getattr(_local, 'phase', None)
+
+
+@contextlib.contextmanager
+def phase(name):
+    '''
+    attribute API calls made by this thread to _name_ and, with
+    --trace-api, add the time spent to the phase totals.  a scope nested
+    in one of the same name (e.g.: eks.render() -> sps.parameters_by_label()
+    -> sps.parameters_list(), all `fetch`) is only counted once, by the
+    outermost
+    '''
+
+    ctx = click.get_current_context(silent=True)
+    tracer = getattr(getattr(ctx, 'obj', None), 'trace', None)
+
+    previous = current_phase()
+    _local.phase = name
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        _local.phase = previous
+
+        if tracer is not None and previous != name:
+            tracer.add_phase(name, time.perf_counter() - start)
+
+
+def timed(name):
+    '''
+    decorator: run the function inside phase(_name_)
+    '''
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextlib.contextmanager
+def inherit(name):
+    '''
+    set the phase of this (worker) thread without timing it
+    '''
+
+    previous = current_phase()
+    _local.phase = name
+
+    try:
+        yield
+    finally:
+        _local.phase = previous
+
+
+class ApiTrace(object):
+    '''
+    thread-safe recorder of API calls and phase timings
+    '''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.calls = []
+        self.phases = dict()
+        self._lock = threading.Lock()
+
+    def record(self, api, operation, latency, status, retries=0, throttles=0,
+               sent=0, received=0):
+
+        with self._lock:
+            self.calls.append({
+                'api': api,
+                'operation': operation,
+                'phase': current_phase(),
+                'latency': latency,
+                'status': status,
+                'retries': retries,
+                'throttles': throttles,
+                'sent': sent,
+                'received': received,
+            })
+
+    def add_phase(self, name, elapsed):
+
+        with self._lock:
+            entry = self.phases.setdefault(name, {'seconds': 0.0, 'count': 0})
+            entry['seconds'] += elapsed
+            entry['count'] += 1
+
+    # botocore
+
+    def instrument_session(self, session):
+        '''
+        session: boto3.Session; register before any client is created
+        '''
+
+        events = session.events
+        events.register('before-call', self._before_call)
+        events.register('needs-retry', self._needs_retry)
+        events.register('after-call', self._after_call)
+
+    @staticmethod
+    def _before_call(params, context, **kwargs):
+
+        # _params_ is the serialized request dict
+        body = params.get('body') or b''
+
+        context['trace'] = {
+            'start': time.perf_counter(),
+            'sent': len(body),
+            'throttles': 0,
+        }
+
+    @staticmethod
+    def _needs_retry(response, request_dict, **kwargs):
+
+        trace = request_dict.get('context', dict()).get('trace')
+
+        if trace is None or not response:
+            return
+
+        code = response[1].get('Error', dict()).get('Code')
+
+        if code in THROTTLE_ERROR_CODES or response[0].status_code == 429:
+            trace['throttles'] += 1
+
+    def _after_call(self, http_response, parsed, model, context, **kwargs):
+
+        trace = context.get('trace')
+
+        if trace is None:
+            return
+
+        self.record(
+            'aws',
+            '{}.{}'.format(model.service_model.service_id, model.name),
+            time.perf_counter() - trace['start'],
+            http_response.status_code,
+            retries=parsed.get('ResponseMetadata', dict()).get('RetryAttempts', 0),
+            throttles=trace['throttles'],
+            sent=trace['sent'],
+            received=len(http_response.content or b''),
+        )
+
+    # kubernetes
+
+    def instrument_kube(self, api_client):
+        '''
+        api_client: kubernetes.client.ApiClient
+        '''
+
+        call_api = api_client.call_api
+        request = api_client.request
+
+        def traced_request(method, url, *args, **kwargs):
+            res = request(method, url, *args, **kwargs)
+            _local.kube_received = getattr(_local, 'kube_received', 0) + len(res.data or b'')
+            return res
+
+        def traced_call_api(resource_path, method, *args, **kwargs):
+            body = kwargs.get('body')
+            _local.kube_received = 0
+            start = time.perf_counter()
+            status = 200
+
+            try:
+                return call_api(resource_path, method, *args, **kwargs)
+            except Exception as e:  # pylint: disable=broad-except
+                status = getattr(e, 'status', None) or 0
+                raise
+            finally:
+                self.record(
+                    'kube',
+                    '{} {}'.format(method, resource_path),
+                    time.perf_counter() - start,
+                    status,
+                    throttles=int(status == 429),
+                    sent=len(body if isinstance(body, str) else json.dumps(
+                        api_client.sanitize_for_serialization(body)
+                    )) if body is not None else 0,
+                    received=_local.kube_received,
+                )
+
+        api_client.request = traced_request
+        api_client.call_api = traced_call_api
+
+    def summary(self):
+        '''
+        return: dict suitable for JSON: totals per operation and per phase
+        '''
+
+        with self._lock:
+            calls = list(self.calls)
+            phases = {k: dict(v) for k, v in self.phases.items()}
+
+        operations = dict()
+
+        for call in calls:
+            entry = operations.setdefault(call['operation'], {
+                'api': call['api'],
+                'calls': 0,
+                'errors': 0,
+                'retries': 0,
+                'throttles': 0,
+                'seconds': 0.0,
+                'max': 0.0,
+                'sent': 0,
+                'received': 0,
+                'phases': dict(),
+            })
+
+            entry['calls'] += 1
+            entry['errors'] += int(not 200 <= call['status'] < 300)
+            entry['retries'] += call['retries']
+            entry['throttles'] += call['throttles']
+            entry['seconds'] += call['latency']
+            entry['max'] = max(entry['max'], call['latency'])
+            entry['sent'] += call['sent']
+            entry['received'] += call['received']
+            entry['phases'][call['phase'] or '-'] = entry['phases'].get(call['phase'] or '-', 0) + 1
+
+        for entry in operations.values():
+            entry['mean'] = entry['seconds'] / entry['calls']
+
+        for name, entry in phases.items():
+            entry['calls'] = len([el for el in calls if el['phase'] == name])
+
+        return {
+            'elapsed': time.perf_counter() - self.started,
+            'calls': len(calls),
+            'throttles': sum(el['throttles'] for el in calls),
+            'retries': sum(el['retries'] for el in calls),
+            'phases': phases,
+            'operations': operations,
+        }
+
+    def emit(self):
+
+        click.echo(json.dumps(self.summary(), indent=2, sort_keys=True), err=True)
@@ -0,0 +1,291 @@
+'''
+batch mode: many environment/component pairs in one process
+
+a manifest is a JSON list of entries:
+
+    [
+        {
+            "environment": "staging",
+            "component": "api",
+            "input_file": "api.env",
+            "update": true,
+            "labels": ["staged"],
+            "targets": ["development-01/api", "development-02/api"]
+        },
+        {
+            "environment": "staging",
+            "component": "worker",
+            "targets": ["development-01/worker"]
+        }
+    ]
+
+an entry with `input_file` or `set_key` is written to SSM first (as
+sync-to-sps); an entry with `targets` is then synced to EKS (as
+sync-to-eks) from its labeled parameter set.  entries run concurrently
+(--jobs) and share the run's AWS clients and rate limits, the KMS alias
+lookup, EKS tokens and kubernetes clients.  the results of every entry are
+reported together at the end.
+'''
+
+import json
+import os
+
+import click
+from botocore.exceptions import ClientError
+
+import env_kube_sps.sps as sps
+from .util import emit_error, concurrent_map, SECRET_LAYOUTS, BATCH_JOBS
+
+
+# manifest entry fields and their JSON types
+ENTRY_FIELDS = {
+    'environment': str,
+    'component': str,
+    'input_file': str,
+    'set_key': list,
+    'update': bool,
+    'secret': bool,
+    'labels': list,
+    'targets': list,
+    'layout': str,
+    'compress': bool,
+    'assume_role': str,
+}
+
+
+def _check_entry(entry):
+    '''
+    return: (str) what is wrong with manifest _entry_, or None
+    '''
+
+    if not isinstance(entry, dict):
+        return 'expected an object'
+
+    for field, value in entry.items():
+        if field not in ENTRY_FIELDS:
+            return 'unknown field, {}'.format(field)
+
+        if not isinstance(value, ENTRY_FIELDS[field]):
+            return '{} must be a {}'.format(field, ENTRY_FIELDS[field].__name__)
+
+    for field in ('environment', 'component'):
+        if not entry.get(field):
+            return '{} is required'.format(field)
+
+    if entry.get('input_file') and entry.get('set_key'):
+        return 'input_file and set_key are exclusive'
+
+    if not (entry.get('input_file') or entry.get('set_key') or entry.get('targets')):
+        return 'nothing to do: input_file, set_key or targets required'
+
+    if [el for el in entry.get('targets', []) if len(str(el).split('/')) != 2]:
+        return 'targets must be <CLUSTER>/<NAMESPACE>'
+
+    if entry.get('layout', 'env') not in SECRET_LAYOUTS:
+        return 'layout must be one of: {}'.format(', '.join(SECRET_LAYOUTS))
+
+    return None
+
+
+@click.pass_context
+def load_manifest(ctx, fh):
+    '''
+    fh: open manifest file
+
+    return: list of entries.  --environment/--component, when given,
+      are the default for entries without their own; relative input_file
+      paths are taken from the manifest's directory
+    '''
+
+    try:
+        entries = json.load(fh)
+    except ValueError as e:
+        raise click.BadParameter('not valid JSON: {}'.format(e), param_hint='MANIFEST')
+
+    if not isinstance(entries, list):
+        raise click.BadParameter('expected a list of entries', param_hint='MANIFEST')
+
+    base = os.path.dirname(os.path.abspath(fh.name)) if fh.name != '<stdin>' else os.getcwd()
+    retval = []
+
+    for idx, el in enumerate(entries):
+        entry = dict(el) if isinstance(el, dict) else el
+
+        if isinstance(entry, dict):
+            for field in ('environment', 'component'):
+                if ctx.find_root().params[field]:
+                    entry.setdefault(field, ctx.find_root().params[field])
+
+            if isinstance(entry.get('input_file'), str):
+                entry['input_file'] = os.path.join(base, entry['input_file'])
+
+        problem = _check_entry(entry)
+
+        if problem:
+            raise click.BadParameter(
+                'entry {}: {}'.format(idx, problem), param_hint='MANIFEST'
+            )
+
+        retval.append(entry)
+
+    return retval
+
+
+def _sync_to_sps_args(entry):
+
+    args = []
+
+    if entry.get('input_file'):
+        args.extend(('--input-file', entry['input_file']))
+
+    for el in entry.get('set_key', []):
+        args.extend(('--set-key', el))
+
+    if entry.get('update'):
+        args.append('--update')
+
+    if 'secret' in entry:
+        args.extend(('--secret', str(entry['secret'])))
+
+    # new versions get the first label; sync-to-eks selects on all of them
+    if entry.get('labels'):
+        args.extend(('--with-label', entry['labels'][0]))
+
+    return args
+
+
+def _sync_to_eks_args(entry):
+
+    args = ['--layout', entry.get('layout', 'env')]
+
+    for el in entry['targets']:
+        args.extend(('--target', el))
+
+    for el in entry.get('labels', []):
+        args.extend(('--with-label', el))
+
+    if entry.get('compress'):
+        args.append('--compress')
+
+    if entry.get('assume_role'):
+        args.extend(('--assume-role', entry['assume_role']))
+
+    return args
+
+
+def _sync_to_sps(root, name, entry):
+    '''
+    return: tuple(name, result, detail) for the entry's SSM write
+    '''
+
+    command = root.command.get_command(root, 'sync-to-sps')
+
+    with command.make_context('sync-to-sps', _sync_to_sps_args(entry), parent=root):
+        if not sps.preflight():
+            return '{} sync-to-sps'.format(name), 'failed', 'preflight'
+
+        sps.ingest()
+        results = sps.sync()
+
+    totals = dict()
+
+    for _, result, _ in results:
+        totals[result] = totals.get(result, 0) + 1
+
+    if 'failed' in totals:
+        result = 'failed'
+    elif 'created' in totals or 'updated' in totals:
+        result = 'updated'
+    else:
+        result = 'unchanged'
+
+    return (
+        '{} sync-to-sps'.format(name),
+        result,
+        ', '.join('{} {}'.format(v, k) for k, v in sorted(totals.items()))
+    )
+
+
+def _sync_to_eks(root, name, entry):
+    '''
+    return: list of tuple(name, result, detail), one per target
+    '''
+
+    # kubernetes is only imported by the commands that talk to a cluster
+    import env_kube_sps.eks as eks
+
+    command = root.command.get_command(root, 'sync-to-eks')
+
+    with command.make_context('sync-to-eks', _sync_to_eks_args(entry), parent=root):
+        return [
+            ('{} -> {}'.format(name, target), result, detail)
+            for target, result, detail in eks.sync()
+        ]
+
+
+@click.pass_context
+def run_entry(ctx, entry):
+    '''
+    sync one manifest _entry_ inside a context of its own: a copy of the
+    root context for the entry's environment/component, sharing the run's
+    clients (see main.Ctx.for_component())
+
+    return: list of tuple(name, result, detail)
+    '''
+
+    # kubernetes is only imported by the commands that talk to a cluster
+    import env_kube_sps.eks as eks
+
+    name = '{environment}/{component}'.format(**entry)
+    main_ctx = ctx.find_root()
+
+    root = click.Context(
+        main_ctx.command,
+        info_name=main_ctx.info_name,
+        obj=ctx.obj.for_component(entry['environment'], entry['component'])
+    )
+    root.params = root.obj.main
+
+    results = []
+
+    try:
+        if entry.get('input_file') or entry.get('set_key'):
+            results.append(_sync_to_sps(root, name, entry))
+
+            if results[-1][1] == 'failed':
+                return results + [
+                    ('{} -> {}'.format(name, el), 'failed', 'sync-to-sps failed')
+                    for el in entry.get('targets', [])
+                ]
+
+        if entry.get('targets'):
+            results.extend(_sync_to_eks(root, name, entry))
+    except click.ClickException as e:
+        results.append((name, 'failed', e.format_message()))
+    except ClientError as e:
+        results.append((name, 'failed', e.response['Error']['Code']))
+    except eks.TARGET_ERRORS as e:
+        # an unreachable endpoint fails this entry, not the whole run
+        emit_error('{}: {}'.format(name, e), force=True, color='red')
+        results.append((name, 'failed', e.__class__.__name__))
+
+    return results
+
+
+@click.pass_context
+def run(ctx, entries, jobs=BATCH_JOBS):
+    '''
+    run _entries_, up to _jobs_ at a time
+
+    return: sorted list of tuple(name, result, detail) for every entry
+    '''
+
+    # every job runs up to --max-concurrency AWS calls through the shared
+    # clients; size their connection pools for all of them
+    ctx.obj.clients.max_concurrency = ctx.obj.max_concurrency * jobs
+
+    return sorted(
+        result
+        for entry_results in concurrent_map(run_entry, entries, max_workers=jobs)
+        for result in entry_results
+    )
@@ -0,0 +1,279 @@
+'''
+on-disk cache shared by env-kube-sps commands
+
+documents are stored as JSON under `--cache-dir` (mode 0600), one file per
+(kind, region, key).  documents holding parameter values are _sealed_:
+encrypted with AES-GCM under a data key issued by the environment's KMS
+key (`alias/[environment]/ssm`), the same key protecting the parameters
+themselves.  reading a sealed document costs a single kms:Decrypt.
+'''
+
+import base64
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import click
+from botocore.exceptions import ClientError
+
+from .util import emit_error
+
+
+CACHE_FORMAT = 1
+
+DEFAULT_CACHE_TTL = 3600
+
+ENCRYPTION_CONTEXT = {'env-kube-sps': 'cache'}
+
+# seconds before expiry at which cached credentials are no longer handed out
+CREDENTIAL_REFRESH_MARGIN = 60
+
+
+def default_cache_dir():
+
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'env-kube-sps'
+    )
+
+
+@click.pass_context
+def cache_file(ctx, kind, *key):
+    '''
+    kind: (str) document type (e.g.: parameters)
+    key: (str) elements identifying the document (e.g.: parameter path)
+    '''
+
+    digest = hashlib.sha256(
+        '\0'.join((ctx.obj.mc.region_name or '',) + key).encode('utf-8')
+    ).hexdigest()[:24]
+
+    return os.path.join(ctx.obj.cache_dir, '{}-{}.json'.format(kind, digest))
+
+
+@click.pass_context
+def _data_key(ctx):
+    '''
+    return: (plaintext, ciphertext blob) of the data key used for sealing.
+    the key is generated once per run unless one was already recovered
+    from an existing document
+    '''
+
+    if not getattr(ctx.obj, 'cache_data_key', None):
+        res = ctx.obj.kms.generate_data_key(
+            KeyId=ctx.obj.kms_alias,
+            KeySpec='AES_256',
+            EncryptionContext=ENCRYPTION_CONTEXT
+        )
+        ctx.obj.cache_data_key = (res['Plaintext'], res['CiphertextBlob'])
+
+    return ctx.obj.cache_data_key
+
+
+def _seal(plaintext, aad):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    key, blob = _data_key()
+    nonce = os.urandom(12)
+
+    return {
+        'key': base64.b64encode(blob).decode('ascii'),
+        'nonce': base64.b64encode(nonce).decode('ascii'),
+        'sealed': base64.b64encode(
+            AESGCM(key).encrypt(nonce, plaintext, aad)
+        ).decode('ascii'),
+    }
+
+
+@click.pass_context
+def _unseal(ctx, doc, aad):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    blob = base64.b64decode(doc['key'])
+
+    key = ctx.obj.kms.decrypt(
+        CiphertextBlob=blob,
+        EncryptionContext=ENCRYPTION_CONTEXT
+    )['Plaintext']
+
+    plaintext = AESGCM(key).decrypt(
+        base64.b64decode(doc['nonce']),
+        base64.b64decode(doc['sealed']),
+        aad
+    )
+
+    ctx.obj.cache_data_key = (key, blob)
+
+    return json.loads(plaintext.decode('utf-8'))
+
+
+def load(kind, *key, ttl=None, sealed=False):
+    '''
+    args:
+      kind, key: see cache_file()
+      ttl: (int) maximum document age in seconds; None for no limit
+      sealed: (bool) document is encrypted
+
+    return: tuple(data, created) or tuple(None, None) if the document is
+      missing, expired or unreadable
+    '''
+
+    path = cache_file(kind, *key)
+
+    try:
+        with open(path) as fh:
+            doc = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None, None
+
+    if doc.get('format') != CACHE_FORMAT:
+        return None, None
+
+    if ttl is not None and time.time() - doc.get('created', 0) > ttl:
+        emit_error('{}: cache expired'.format(path))
+        return None, None
+
+    if not sealed:
+        return doc.get('data'), doc['created']
+
+    # cryptography is only loaded when a sealed document is read or written
+    from cryptography.exceptions import InvalidTag
+
+    try:
+        return _unseal(doc, path.encode('utf-8')), doc['created']
+    except (ClientError, InvalidTag, KeyError, ValueError) as e:
+        emit_error(
+            '{}: unable to decrypt cache ({})'.format(path, e),
+            color='yellow'
+        )
+        return None, None
+
+
+def store(kind, data, *key, created=None, sealed=False):
+    '''
+    args:
+      kind, key: see cache_file()
+      data: JSON-serializable document
+      created: (float) creation time to carry forward (TTL is measured from
+        this rather than the time of the write)
+      sealed: (bool) encrypt the document
+
+    return: (bool) True if written
+    '''
+
+    path = cache_file(kind, *key)
+
+    doc = {
+        'format': CACHE_FORMAT,
+        'created': created or time.time(),
+    }
+
+    if sealed:
+        try:
+            doc.update(_seal(json.dumps(data).encode('utf-8'), path.encode('utf-8')))
+        except ClientError as e:
+            emit_error(
+                '{}: unable to encrypt cache ({})'.format(path, e),
+                color='yellow'
+            )
+            return False
+    else:
+        doc['data'] = data
+
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+
+    # mkstemp creates the file 0600
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+
+    with os.fdopen(fd, 'w') as fh:
+        json.dump(doc, fh)
+
+    os.replace(tmp_path, path)
+
+    return True
+
+
+@click.pass_context
+def invalidate(ctx, kind=None, *key):
+    '''
+    remove cached documents.  with no _kind_, every document is removed;
+    with no _key_, every document of _kind_
+
+    return: list of removed files
+    '''
+
+    if kind and key:
+        paths = [cache_file(kind, *key)]
+    else:
+        paths = glob.glob(
+            os.path.join(ctx.obj.cache_dir, '{}-*.json'.format(kind or '*'))
+        )
+
+    removed = []
+
+    for path in paths:
+        try:
+            os.remove(path)
+            removed.append(path)
+        except FileNotFoundError:
+            pass
+
+    return removed
+
+
+class CredentialCache(object):
+    '''
+    expiring credentials (EKS tokens, assumed-role credentials) keyed by
+    tuple(str).  entries are held in memory and, with _persist_, in an
+    unsealed cache document (mode 0600) so later runs can reuse them.
+    '''
+
+    def __init__(self, persist=False):
+        self._persist = persist
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+
+        if self._entries is None:
+            self._entries = dict()
+
+            if self._persist:
+                self._entries = load('credentials', 'eks')[0] or dict()
+
+    def get(self, *key):
+        '''
+        return: cached value, or None if missing or about to expire
+        '''
+
+        with self._lock:
+            self._load()
+            entry = self._entries.get('\0'.join(key))
+
+        if entry and entry['expires'] - CREDENTIAL_REFRESH_MARGIN > time.time():
+            return entry['value']
+
+        return None
+
+    def put(self, value, expires, *key):
+        '''
+        value: JSON-serializable credential
+        expires: (float) expiry as epoch seconds
+        '''
+
+        with self._lock:
+            self._load()
+
+            now = time.time()
+
+            self._entries = {
+                k: v for k, v in self._entries.items() if v['expires'] > now
+            }
+            self._entries['\0'.join(key)] = {'value': value, 'expires': expires}
+
+            if self._persist:
+                store('credentials', self._entries, 'eks')
@@ -0,0 +1,169 @@
+'''
+the boto3 session and clients of a run
+
+every client comes from one session whose default client configuration
+uses botocore's adaptive retry mode and a connection pool sized to
+--max-concurrency.  calls can be held to a rate by token buckets per
+service (`--api-rate ssm=40`) and per operation (`--api-rate
+ssm.PutParameter=3`, `sync-to-sps --tps`); the buckets are shared by every
+thread and client in the process and are charged for every attempt, so
+botocore's own retries are held to the same rates.  throttled responses are
+counted per operation and reported when the run ends.
+'''
+
+import re
+import threading
+
+from .util import (
+    emit_error, TokenBucket, DEFAULT_MAX_CONCURRENCY, THROTTLE_ERROR_CODES
+)
+
+
+# attempts per call (first try included) before botocore gives up
+RETRY_MAX_ATTEMPTS = 5
+
+# --api-rate <SERVICE>[.<Operation>]=<TPS>
+API_RATE_REX = re.compile(r'^\s*([a-z0-9-]+)(?:\.(\w+))?\s*=\s*(\d+(?:\.\d+)?)\s*$')
+
+
+def parse_api_rate(value):
+    '''
+    return: tuple(service, operation or None, rate) from an --api-rate value
+      (None if it is malformed)
+    '''
+
+    match = API_RATE_REX.match(value)
+
+    if not match or not float(match.group(3)):
+        return None
+
+    return match.group(1), match.group(2), float(match.group(3))
+
+
+class ClientFactory(object):
+    '''
+    boto3 session, clients and rate limiters shared by a run
+
+    max_concurrency: sizes each client's connection pool
+    trace: apitrace.ApiTrace instrumenting the session (optional)
+    '''
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, trace=None):
+        self.max_concurrency = max_concurrency
+        self.trace = trace
+        self.throttles = dict()
+        self._session = None
+        self._clients = dict()
+        self._buckets = dict()
+        self._service_names = dict()
+        self._lock = threading.Lock()
+
+    # the session and clients are created on first use so that --help,
+    # usage errors and commands needing only some clients don't pay for all
+
+    @property
+    def session(self):
+
+        with self._lock:
+            if self._session is None:
+                import boto3
+                import botocore.session
+                from botocore.config import Config
+
+                core = botocore.session.get_session()
+                core.set_default_client_config(Config(
+                    retries={'mode': 'adaptive', 'max_attempts': RETRY_MAX_ATTEMPTS},
+                    max_pool_connections=max(10, self.max_concurrency)
+                ))
+
+                # first, ahead of any handler that answers the request itself
+                core.get_component('event_emitter').register_first(
+                    'before-send', self._before_send
+                )
+                core.register('needs-retry', self._needs_retry)
+
+                self._session = boto3.Session(botocore_session=core)
+
+                if self.trace is not None:
+                    self.trace.instrument_session(self._session)
+
+        return self._session
+
+    def client(self, service):
+
+        session = self.session
+
+        with self._lock:
+            if service not in self._clients:
+                self._clients[service] = session.client(service)
+                self._service_names[
+                    self._clients[service].meta.service_model.service_id.hyphenize()
+                ] = service
+
+        return self._clients[service]
+
+    def limit(self, service, rate, operation=None):
+        '''
+        hold calls to _service_ (or only its _operation_) to _rate_ calls per
+        second.  an existing bucket is re-rated, keeping its state, so
+        concurrent users of the same operation keep sharing it
+        '''
+
+        with self._lock:
+            bucket = self._buckets.get((service, operation))
+
+            if bucket is None:
+                self._buckets[(service, operation)] = TokenBucket(rate)
+            else:
+                bucket.rate = float(rate)
+                bucket.capacity = max(1.0, bucket.rate)
+
+    def _before_send(self, event_name, **kwargs):
+
+        # before-send.<service id>.<Operation> fires once per attempt
+        _, service_id, operation = event_name.split('.', 2)
+        service = self._service_names.get(service_id, service_id)
+
+        for key in ((service, operation), (service, None)):
+            bucket = self._buckets.get(key)
+
+            if bucket is not None:
+                bucket.acquire()
+
+    def _needs_retry(self, response, operation, **kwargs):
+
+        if not response:
+            return
+
+        code = response[1].get('Error', dict()).get('Code')
+
+        if code in THROTTLE_ERROR_CODES or response[0].status_code == 429:
+            name = '{}.{}'.format(operation.service_model.service_name, operation.name)
+
+            with self._lock:
+                self.throttles[name] = self.throttles.get(name, 0) + 1
+
+    def report(self):
+        '''
+        emit throttle counts and time spent waiting on rate limits, if any
+        '''
+
+        with self._lock:
+            throttles = sorted(self.throttles.items())
+            waits = sorted((
+                ('.'.join(el for el in key if el), bucket)
+                for key, bucket in self._buckets.items()
+                if bucket.waited
+            ), key=lambda el: el[0])
+
+        for name, count in throttles:
+            emit_error(
+                '{}: throttled {} times'.format(name, count),
+                force=True,
+                color='yellow'
+            )
+
+        for name, bucket in waits:
+            emit_error('{}: calls held back {:.1f}s by the {:g} calls/second limit'.format(
+                name, bucket.waited, bucket.rate
+            ))
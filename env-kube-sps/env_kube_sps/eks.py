@@ -1,37 +1,97 @@
 # pylint: disable=wrong-import-order,missing-function-docstring,missing-class-docstring,missing-module-docstring,no-value-for-parameter,invalid-name
 
-from env_kube_sps.util import emit_error, get_eks_token
+import threading
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+from env_kube_sps.util import (
+    emit_error, emit_summary, get_eks_token, concurrent_map, credential_identity,
+    WATCH_INTERVAL, WATCH_RESYNC
+)
+import env_kube_sps.apitrace as apitrace
+import env_kube_sps.cache as cache
 import env_kube_sps.kube as kube
 import env_kube_sps.sps as sps
 import kubernetes as K
 import click
+import urllib3
+
+
+# seconds cluster endpoint/CA data is reused from the on-disk cache
+CLUSTER_CACHE_TTL = 86400
+
+# failures confined to a single target: API errors, and clusters (or AWS
+# endpoints) that cannot be reached
+TARGET_ERRORS = (
+    K.client.exceptions.ApiException,
+    ClientError,
+    BotoCoreError,
+    urllib3.exceptions.HTTPError,
+    OSError,
+)
+
 
 
 @click.pass_context
 def check_cluster(ctx):
+    '''
+    resolve endpoint/CA data for ctx.params['cluster_name'] into
+    ctx.obj.eks_clusters.  with --cache, cluster metadata is kept on disk
+    for CLUSTER_CACHE_TTL seconds per region and credential identity;
+    misses are a single DescribeCluster
+    '''
 
     cluster_name = ctx.params['cluster_name']
     eks = ctx.obj.eks
 
-    if cluster_name not in ctx.obj.eks_clusters.keys():
-        try:
-            cluster_list = eks.list_clusters()['clusters']
+    if cluster_name in ctx.obj.eks_clusters.keys():
+        return True
 
-            if cluster_name in cluster_list:
-                ctx.obj.eks_clusters.update(
-                    {
-                        cluster_name: eks.describe_cluster(name=cluster_name)['cluster']
-                    }
-                )
+    # keyed by the credentials in use: a profile name says nothing about
+    # the account behind env-var or instance credentials
+    identity = credential_identity(ctx.obj.mc)
+
+    clusters = dict()
+
+    if ctx.obj.use_cache:
+        clusters = {
+            name: cluster
+            for name, cluster in (cache.load('clusters', identity)[0] or dict()).items()
+            if time.time() - cluster['cached'] < CLUSTER_CACHE_TTL
+        }
 
+    if cluster_name not in clusters:
+        try:
+            cluster = eks.describe_cluster(name=cluster_name)['cluster']
+        except eks.exceptions.ResourceNotFoundException:
+            emit_error(
+                'eks cluster, {}, not found in {}'.format(
+                    cluster_name, ctx.obj.mc.region_name
+                ),
+                color='red',
+                force=True
+            )
+
+            return False
         except eks.exceptions.ClientError:
             emit_error(
-                'Access to IAM EKS:ListClusters required for this operation',
+                'Access to IAM EKS:DescribeCluster required for this operation',
                 color='bright_white',
                 force=True
             )
 
             return False
+
+        clusters[cluster_name] = {
+            k: cluster[k] for k in ('name', 'arn', 'endpoint', 'certificateAuthority')
+        }
+        clusters[cluster_name]['cached'] = time.time()
+
+        if ctx.obj.use_cache:
+            cache.store('clusters', clusters, identity)
+
+    ctx.obj.eks_clusters.update({cluster_name: clusters[cluster_name]})
+
     return True
 
 @click.pass_context
@@ -79,7 +139,7 @@ def _kubeconfig(ctx):
 @click.pass_context
 def check_namespace(ctx):
     try:
-        ctx.obj.kv1.read_namespace(ctx.params['namespace'])
+        kube.core_api().read_namespace(ctx.params['namespace'])
     except K.client.exceptions.ApiException:
         emit_error(
             'namespace, {}, does not exist'.format(ctx.params['namespace']),
@@ -93,14 +153,50 @@ def check_namespace(ctx):
 
 
 @click.pass_context
+def api_client(ctx):
+    '''
+    return: kubernetes ApiClient for ctx.params['cluster_name'] (None if the
+      cluster cannot be resolved).  one client is built per cluster and
+      --assume-role (see kube.client_key()) and shared by every namespace
+      targeted through it.  the bearer token is re-read from
+      get_eks_token() on each request, so long-lived clients pick up a
+      fresh token, for the role they were built for, before the old one
+      expires
+    '''
+
+    def refresh_token(configuration):
+        with ctx.scope(cleanup=False):
+            configuration.api_key['authorization'] = 'Bearer {}'.format(
+                get_eks_token()['status']['token']
+            )
+
+    key = kube.client_key()
+
+    with ctx.obj.kube_locks.setdefault(key, threading.Lock()):
+        if key not in ctx.obj.kube_clients:
+            if not check_cluster():
+                return None
+
+            configuration = K.client.Configuration()
+            K.config.load_kube_config_from_dict(
+                _kubeconfig(),
+                client_configuration=configuration
+            )
+            configuration.refresh_api_key_hook = refresh_token
+            ctx.obj.kube_clients[key] = K.client.ApiClient(configuration)
+
+            if ctx.obj.trace is not None:
+                ctx.obj.trace.instrument_kube(ctx.obj.kube_clients[key])
+
+    return ctx.obj.kube_clients[key]
+
+
+@click.pass_context
+@apitrace.timed('preflight')
 def preflight(ctx):
-    if not check_cluster():
+    if not api_client():
         return False
 
-    K.config.load_kube_config_from_dict(_kubeconfig())
-    ctx.obj.kv1 = K.client.CoreV1Api()
-    ctx.obj.kauthv1 = K.client.AuthorizationV1Api()
-
     if not kube.check_rbac('secrets'):
         return False
 
@@ -111,50 +207,292 @@ def preflight(ctx):
 
 
 @click.pass_context
-def sync(ctx):
+def targets(ctx):
+    '''
+    return: sorted list of tuple(cluster name, namespace) built from every
+      --target plus the product of --cluster-name and --namespace
+    '''
+
+    retval = {
+        tuple(el.split('/', 1))
+        for el in ctx.params['target']
+    }
+
+    retval.update(
+        (cluster_name, namespace)
+        for cluster_name in ctx.params['cluster_name']
+        for namespace in ctx.params['namespace']
+    )
+
+    return sorted(retval)
+
+
+@click.pass_context
+def _target_context(ctx, cluster_name, namespace):
+    '''
+    a copy of the sync-to-eks context narrowed to a single cluster/namespace
+    so the per-target helpers can keep reading ctx.params
+    '''
+
+    target_ctx = click.Context(
+        ctx.command,
+        parent=ctx.parent,
+        info_name=ctx.info_name,
+        obj=ctx.obj
+    )
+
+    target_ctx.params = dict(
+        ctx.params,
+        cluster_name=cluster_name,
+        namespace=namespace
+    )
+
+    return target_ctx
+
+
+@click.pass_context
+@apitrace.timed('fetch')
+def render(ctx):
+    '''
+    return: list of V1Secret: the component secret built from the labeled
+      parameter set, laid out according to --layout, followed by any shards
+      (see kube.sharded_secrets())
+    '''
 
-    k_namespace = ctx.params['namespace']
     component = ctx.parent.params['component']
     sps_labels = ctx.params['with_label']
 
     if not sps_labels:
         sps_labels = ['staged']
 
-    param_objects = sps.parameters_by_label(sps_labels, refresh=True)
+    # sorted so the content hash does not depend on the order SSM returns
+    # parameters in
+    param_objects = sorted(
+        sps.parameters_by_label(sps_labels, refresh=True),
+        key=lambda el: el['Name']
+    )
+
+    if ctx.params['layout'] == 'keys':
+        param_data = {
+            el['Name'].split('/')[-1]: el['Value']
+            for el in param_objects
+        }
+    else:
+        params = '\n'.join([
+            '='.join(
+                (el['Name'].split('/')[-1], el['Value'],)
+            ) for el in param_objects
+        ])
+
+        param_data = {'environment': params}
 
-    params = '\n'.join([
-        '='.join(
-            (el['Name'].split('/')[-1], el['Value'],)
-        ) for el in param_objects
-    ])
+    secret_name = '{}-env'.format(component)
 
-    param_data = {'environment': params}
+    return kube.sharded_secrets(secret_name, param_data, compress=ctx.params['compress'])
 
-    secret_name = '{}-env'.format(component)
 
-    secret_obj = kube.secret(secret_name, param_data)
+@click.pass_context
+def _write(ctx, secret_obj, exists):
+    '''
+    server-side apply _secret_obj_ or, with `--layout keys` and an
+    existing secret, merge-patch only the keys that changed
 
-    try:
-        ctx.obj.kv1.create_namespaced_secret(
-            namespace=k_namespace,
-            body=secret_obj
-        )
+    return: list of str, details for the report
+    '''
 
-        emit_error(
-            'secret, {}, created in namespace {}'.format(secret_name, k_namespace),
-            force=True,
-            color="green"
-        )
-    except K.client.exceptions.ApiException as e:
-        if e.reason == 'Conflict':
-            ctx.obj.kv1.patch_namespaced_secret(  # noqa
-                name=secret_name,
-                namespace=k_namespace,
-                body=secret_obj
+    if exists and ctx.params['layout'] == 'keys':
+        return ['{} keys'.format(kube.patch_changed_keys(secret_obj))]
+
+    kube.apply(secret_obj)
+
+    return []
+
+
+@click.pass_context
+@apitrace.timed('write')
+def push(ctx, secrets):
+    '''
+    write _secrets_ (see render()) to ctx.params['namespace'].  nothing is
+    written when the live first secret carries the same content hash;
+    otherwise shards whose hash differs from the live manifest are written
+    first, then the first secret, and shards no longer in the manifest are
+    deleted
+
+    return: (str) created, updated or unchanged
+    '''
+
+    k_namespace = ctx.params['namespace']
+    secret_obj = secrets[0]
+    secret_name = secret_obj.metadata['name']
+    digest = secret_obj.metadata['annotations'][kube.CONTENT_HASH_ANNOTATION]
+
+    current = kube.read_secret_metadata(secret_name)
+
+    if current is not None:
+        if (current.get('annotations') or dict()).get(kube.CONTENT_HASH_ANNOTATION) == digest:
+            emit_error(
+                'secret, {}, unchanged in {}/{}'.format(
+                    secret_name, ctx.params['cluster_name'], k_namespace
+                )
+            )
+
+            return 'unchanged'
+
+    live_shards = kube.shard_manifest(current or dict())['shards']
+
+    for shard in secrets[1:]:
+        shard_name = shard.metadata['name']
+
+        if live_shards.get(shard_name) != shard.metadata['annotations'][kube.CONTENT_HASH_ANNOTATION]:
+            detail = _write(shard, shard_name in live_shards)
+
+            emit_error(
+                'secret, {}, written in {}/{}{}'.format(
+                    shard_name, ctx.params['cluster_name'], k_namespace,
+                    ' ({})'.format(', '.join(detail)) if detail else ''
+                )
             )
 
+    detail = _write(secret_obj, current is not None)
+
+    for shard_name in sorted(set(live_shards) - {el.metadata['name'] for el in secrets}):
+        kube.delete_secret(shard_name)
+
         emit_error(
-            'secret, {}, updated in namespace {}'.format(secret_name, k_namespace),
-            force=True,
-            color="green"
+            'secret, {}, pruned from {}/{}'.format(
+                shard_name, ctx.params['cluster_name'], k_namespace
+            )
         )
+
+    result = 'created' if current is None else 'updated'
+
+    if len(secrets) > 1:
+        detail.insert(0, '{} shards'.format(len(secrets)))
+
+    emit_error(
+        'secret, {}, {} in {}/{}{}'.format(
+            secret_name, result, ctx.params['cluster_name'], k_namespace,
+            ' ({})'.format(', '.join(detail)) if detail else ''
+        ),
+        force=True,
+        color="green"
+    )
+
+    return result
+
+
+@click.pass_context
+def _sync_targets(ctx, secrets, target_list):
+    '''
+    preflight and write _secrets_ to every (cluster, namespace) in
+    _target_list_ concurrently (--max-concurrency)
+
+    return: sorted list of tuple(cluster/namespace, result, detail)
+    '''
+
+    def sync_target(target):
+        name = '/'.join(target)
+
+        with _target_context(*target).scope(cleanup=False):
+            try:
+                if not preflight():
+                    return name, 'failed', 'preflight'
+
+                return name, push(secrets), ''
+            except TARGET_ERRORS as e:
+                emit_error('{}: {}'.format(name, e), force=True, color='red')
+                return name, 'failed', str(getattr(e, 'reason', e))
+
+    return sorted(concurrent_map(sync_target, target_list))
+
+
+@click.pass_context
+def sync(ctx):
+    '''
+    return: list of tuple(cluster/namespace, result, detail)
+
+    the labeled parameter set is fetched once; every target is then
+    preflighted and written concurrently (--max-concurrency)
+    '''
+
+    return _sync_targets(render(), targets())
+
+
+@click.pass_context
+@apitrace.timed('fetch')
+def parameter_metadata(ctx):
+    '''
+    return: dict of {name: (version, last modified)} for ctx.obj.sps_prefix;
+      DescribeParameters only, nothing is decrypted
+    '''
+
+    return {
+        param['Name']: (param['Version'], param['LastModifiedDate'].timestamp())
+        for param in sps._describe_parameters(ctx.obj.ssm, ctx.obj.sps_prefix)
+    }
+
+
+@click.pass_context
+def watch(ctx, interval=WATCH_INTERVAL, resync=WATCH_RESYNC, iterations=None):
+    '''
+    poll parameter metadata every _interval_ seconds and re-render the
+    secret when it changes (or every _resync_ seconds).  a target is
+    written only when the rendered content differs from what was last
+    written to it; failed targets, and passes that fail outright (e.g.:
+    SSM unreachable), are retried on the next pass.  sessions, kube
+    clients and tokens are kept across passes
+
+    iterations: (int) stop after this many passes (None: run until
+      interrupted)
+
+    return: results of the last pass that wrote anything
+    '''
+
+    target_list = targets()
+    written = dict()
+    metadata = None
+    last_render = 0
+    results = []
+    passes = 0
+
+    while True:
+        try:
+            current = parameter_metadata()
+            now = time.time()
+
+            if now - last_render >= resync:
+                written.clear()
+
+            if current != metadata or len(written) < len(target_list):
+                secrets = render()
+                digest = secrets[0].metadata['annotations'][kube.CONTENT_HASH_ANNOTATION]
+                last_render = now
+
+                stale = [el for el in target_list if written.get(el) != digest]
+
+                if stale:
+                    results = _sync_targets(secrets, stale)
+                    emit_summary(results)
+
+                    written.update(
+                        (tuple(name.split('/', 1)), digest)
+                        for name, result, _ in results
+                        if result != 'failed'
+                    )
+
+                metadata = current
+        except TARGET_ERRORS as e:
+            # SSM or the network failing this pass; the next pass retries
+            # from the last metadata that was fully synced
+            emit_error(
+                'watch: {} (retrying in {}s)'.format(e, interval),
+                force=True,
+                color='red'
+            )
+
+        passes += 1
+
+        if iterations and passes >= iterations:
+            return results
+
+        time.sleep(interval)
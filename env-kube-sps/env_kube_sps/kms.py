@@ -1,10 +1,12 @@
 
 
 from env_kube_sps.util import emit_error
+import env_kube_sps.apitrace as apitrace
 import click
 
 
 @click.pass_context
+@apitrace.timed('preflight')
 def check_key(ctx):
     '''
     check for presense of kms key
@@ -13,9 +15,15 @@ def check_key(ctx):
 
     kms = ctx.obj.kms
 
-    ctx.obj.kms_aliases.extend(
-        kms.list_aliases()['Aliases']
-    )
+    # aliases are listed once per run and shared by every component of a
+    # `batch` run
+    with ctx.obj.kms_lock:
+        if not ctx.obj.kms_aliases:
+            ctx.obj.kms_aliases.extend(
+                el
+                for page in kms.get_paginator('list_aliases').paginate()
+                for el in page['Aliases']
+            )
 
     check = [
         el
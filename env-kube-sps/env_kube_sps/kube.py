@@ -1,48 +1,402 @@
+import base64
+import gzip
+import hashlib
+import json
+import time
+
 import click
 import kubernetes as K
-from env_kube_sps.util import emit_error, secret_labels, whoami
+import env_kube_sps.cache as cache
+from env_kube_sps.util import (
+    emit_error, secret_labels, whoami, concurrent_map, credential_identity
+)
+
+
+RBAC_VERBS = ('get', 'create', 'patch', 'delete', 'list')
+
+# seconds an RBAC preflight answer is reused
+RBAC_CACHE_TTL = 300
+
+# server-side apply field manager for every object written by this tool
+FIELD_MANAGER = 'env-kube-sps'
+
+# sha256 of the rendered secret content; a matching annotation skips the write
+CONTENT_HASH_ANNOTATION = 'env-kube-sps/content-hash'
+
+SECRET_PATH = '/api/v1/namespaces/{namespace}/secrets/{name}'
+
+# base64 data bytes per secret before the payload is sharded; well under the
+# 1 MiB object limit to leave room for metadata and managedFields
+SHARD_LIMIT = 768 * 1024
+
+# on the first secret of a sharded or compressed payload: JSON manifest of
+# the shard secrets (and their content hashes), value encoding and split keys
+SHARDS_ANNOTATION = 'env-kube-sps/shards'
+
+# on every shard: name of the first secret
+SHARD_OF_LABEL = 'env-kube-sps/shard-of'
+
+
+@click.pass_context
+def client_key(ctx):
+    '''
+    return: key of the ApiClient in ctx.obj.kube_clients for the active
+      target: tuple(cluster name, --assume-role).  targets on one cluster
+      reached through different roles get clients (and tokens) of their own
+    '''
+
+    return ctx.params['cluster_name'], ctx.params['assume_role'] or ''
+
+
+@click.pass_context
+def core_api(ctx):
+    '''
+    CoreV1Api bound to the active target's client (see eks.api_client())
+    '''
+
+    return K.client.CoreV1Api(ctx.obj.kube_clients[client_key()])
+
+
+@click.pass_context
+def auth_api(ctx):
+    '''
+    AuthorizationV1Api bound to the active target's client
+    '''
+
+    return K.client.AuthorizationV1Api(ctx.obj.kube_clients[client_key()])
+
+
+def content_hash(secret_obj):
+    '''
+    return: (str) sha256 over the type, labels, annotations (other than the
+      content hash itself) and data of _secret_obj_
+    '''
+
+    annotations = {
+        k: v for k, v in secret_obj.metadata['annotations'].items()
+        if k != CONTENT_HASH_ANNOTATION
+    }
+
+    return hashlib.sha256(
+        json.dumps(
+            [secret_obj.type, secret_obj.metadata['labels'], annotations, secret_obj.data],
+            sort_keys=True
+        ).encode('utf-8')
+    ).hexdigest()
+
 
 @click.pass_context
-def secret(ctx, name, secrets):
+def secret(ctx, name, secrets, labels=None, annotations=None):
     '''
     name: str
-    secrets: tuple(tuple(str, str),)
+    secrets: dict of {str: str or bytes}
+    labels, annotations: dict of {str: str} added to the secret's metadata
+
+    values are base64 encoded into `data` (rather than `stringData`) so that
+    server-side apply tracks ownership of, and prunes, individual keys
     '''
 
-    labels = secret_labels()
+    metadata_labels = secret_labels()
 
-    labels.update({
+    metadata_labels.update({
         'heritage': __package__,
         'environment': ctx.parent.params['environment']
     })
+    metadata_labels.update(labels or dict())
 
     retval = K.client.V1Secret(
+        api_version='v1',
+        kind='Secret',
         type="opaque",
-        metadata={'name': name, 'labels': labels},
-        string_data=secrets
+        metadata={
+            'name': name,
+            'labels': metadata_labels,
+            'annotations': dict(annotations or dict())
+        },
+        data={
+            k: base64.b64encode(
+                v.encode('utf-8') if isinstance(v, str) else v
+            ).decode('ascii')
+            for k, v in secrets.items()
+        }
     )
 
+    retval.metadata['annotations'][CONTENT_HASH_ANNOTATION] = content_hash(retval)
+
+    return retval
+
+
+def _b64len(size):
+
+    return (size + 2) // 3 * 4
+
+
+def sharded_secrets(name, secrets, compress=False, limit=SHARD_LIMIT):
+    '''
+    name: str
+    secrets: dict of {str: str}
+    compress: (bool) gzip each value
+    limit: (int) base64 data bytes per secret
+
+    return: list of V1Secret; the first is _name_, any others are
+      _name_-1, _name_-2, ...
+
+    keys are packed, in sorted order, into as few secrets as _limit_
+    allows.  a value too large for one secret is split into `KEY.0`,
+    `KEY.1`, ... parts to be concatenated in order.  a payload that fits
+    one uncompressed secret is returned as-is; otherwise the first secret
+    carries a SHARDS_ANNOTATION manifest covering the content hash of every
+    other shard, so its own hash changes whenever any shard does
+    '''
+
+    entries = []
+    split = dict()
+
+    for key in sorted(secrets):
+        raw = secrets[key].encode('utf-8')
+
+        if compress:
+            raw = gzip.compress(raw, mtime=0)
+
+        if _b64len(len(raw)) + len(key) <= limit:
+            entries.append((key, raw))
+            continue
+
+        step = (limit - len(key) - 16) // 4 * 3
+        parts = [raw[i:i + step] for i in range(0, len(raw), step)]
+        split[key] = len(parts)
+        entries.extend(('{}.{}'.format(key, i), part) for i, part in enumerate(parts))
+
+    shards = [dict()]
+    size = 0
+
+    for key, raw in entries:
+        entry_size = len(key) + _b64len(len(raw))
+
+        if shards[-1] and size + entry_size > limit:
+            shards.append(dict())
+            size = 0
+
+        shards[-1][key] = raw
+        size += entry_size
+
+    if len(shards) == 1 and not compress:
+        return [secret(name, secrets)]
+
+    labels = {SHARD_OF_LABEL: name}
+
+    retval = [
+        secret('{}-{}'.format(name, i), shard, labels=labels)
+        for i, shard in enumerate(shards[1:], 1)
+    ]
+
+    manifest = {
+        'encoding': 'gzip' if compress else 'identity',
+        'shards': {
+            el.metadata['name']: el.metadata['annotations'][CONTENT_HASH_ANNOTATION]
+            for el in retval
+        },
+        'split': split,
+    }
+
+    retval.insert(0, secret(
+        name,
+        shards[0],
+        labels=labels,
+        annotations={SHARDS_ANNOTATION: json.dumps(manifest, sort_keys=True)}
+    ))
+
     return retval
 
+
+def shard_manifest(metadata):
+    '''
+    return: SHARDS_ANNOTATION manifest from secret _metadata_ (dict), or an
+      empty manifest
+    '''
+
+    try:
+        return json.loads((metadata.get('annotations') or dict())[SHARDS_ANNOTATION])
+    except (KeyError, ValueError):
+        return {'shards': dict()}
+
+
 @click.pass_context
-def check_rbac(ctx, kind):
+def delete_secret(ctx, name):
     '''
-    kind: Kubernetes object _kind_ (e.g.: deployment, daemonset, secret, etc)
+    delete secret _name_ from ctx.params['namespace']; a missing secret is
+    not an error
     '''
 
-    retval = True
+    try:
+        core_api().delete_namespaced_secret(name, ctx.params['namespace'])
+    except K.client.exceptions.ApiException as e:
+        if e.status != 404:
+            raise
+
+
+@click.pass_context
+def read_secret_metadata(ctx, name):
+    '''
+    return: metadata dict of secret _name_ in ctx.params['namespace'], or
+      None if it does not exist.  the request asks for PartialObjectMetadata
+      so the secret data never crosses the wire
+    '''
+
+    api_client = ctx.obj.kube_clients[client_key()]
+
+    try:
+        res = api_client.call_api(
+            SECRET_PATH, 'GET',
+            {'namespace': ctx.params['namespace'], 'name': name},
+            [],
+            {'Accept': 'application/json;as=PartialObjectMetadata;g=meta.k8s.io;v=v1'},
+            response_type='object',
+            auth_settings=['BearerToken'],
+            _return_http_data_only=True
+        )
+    except K.client.exceptions.ApiException as e:
+        if e.status == 404:
+            return None
+        raise
 
-    for action in ('create', 'update', 'delete', 'list'):
+    return res.get('metadata') or dict()
+
+
+@click.pass_context
+def apply(ctx, obj, path=SECRET_PATH):
+    '''
+    server-side apply _obj_ (as FIELD_MANAGER, forcing conflicts) into
+    ctx.params['namespace'].  creates the object if it does not exist
+
+    return: V1Secret
+    '''
+
+    api_client = ctx.obj.kube_clients[client_key()]
+
+    return api_client.call_api(
+        path, 'PATCH',
+        {'namespace': ctx.params['namespace'], 'name': obj.metadata['name']},
+        [('fieldManager', FIELD_MANAGER), ('force', 'true')],
+        {
+            'Content-Type': 'application/apply-patch+yaml',
+            'Accept': 'application/json'
+        },
+        body=json.dumps(api_client.sanitize_for_serialization(obj)),
+        response_type='V1Secret',
+        auth_settings=['BearerToken'],
+        _return_http_data_only=True
+    )
+
+
+@click.pass_context
+def patch_changed_keys(ctx, secret_obj):
+    '''
+    JSON merge patch the live secret in ctx.params['namespace'] so its data
+    matches _secret_obj_: changed and new keys are set, keys no longer
+    present are removed and untouched keys are left out of the patch.
+    labels and annotations are carried along
+
+    return: (int) number of data keys in the patch
+    '''
+
+    name = secret_obj.metadata['name']
+    api_client = ctx.obj.kube_clients[client_key()]
+
+    live_data = core_api().read_namespaced_secret(name, ctx.params['namespace']).data or dict()
+
+    data = {
+        k: v for k, v in secret_obj.data.items() if live_data.get(k) != v
+    }
+    data.update({k: None for k in live_data if k not in secret_obj.data})
+
+    # a merge patch only removes what it names: drop shard metadata left
+    # from an earlier, sharded write
+    labels = dict({SHARD_OF_LABEL: None}, **secret_obj.metadata['labels'])
+    annotations = dict({SHARDS_ANNOTATION: None}, **secret_obj.metadata['annotations'])
+
+    api_client.call_api(
+        SECRET_PATH, 'PATCH',
+        {'namespace': ctx.params['namespace'], 'name': name},
+        [('fieldManager', FIELD_MANAGER)],
+        {
+            'Content-Type': 'application/merge-patch+json',
+            'Accept': 'application/json'
+        },
+        body={
+            'metadata': {
+                'labels': labels,
+                'annotations': annotations
+            },
+            'data': data
+        },
+        response_type='V1Secret',
+        auth_settings=['BearerToken'],
+        _return_http_data_only=True
+    )
+
+    return len(data)
+
+
+def _rule_allows(rule, verb, resource, group=''):
+    '''
+    True if a V1ResourceRule grants _verb_ on every _resource_ object.
+    rules limited to resourceNames do not count
+    '''
+
+    return (
+        not rule.resource_names
+        and ('*' in rule.verbs or verb in rule.verbs)
+        and ('*' in (rule.api_groups or []) or group in (rule.api_groups or []))
+        and ('*' in (rule.resources or []) or resource in (rule.resources or []))
+    )
+
+
+@click.pass_context
+def _rules_review(ctx, resource):
+    '''
+    return: dict of {verb: allowed} from a single SelfSubjectRulesReview, or
+      None if the server could not give a complete answer
+    '''
+
+    res = auth_api().create_self_subject_rules_review(
+        body=K.client.V1SelfSubjectRulesReview(
+            api_version='authorization.k8s.io/v1',
+            kind='SelfSubjectRulesReview',
+            spec=K.client.V1SelfSubjectRulesReviewSpec(
+                namespace=ctx.params['namespace']
+            )
+        )
+    )
+
+    if res.status.incomplete:
+        return None
+
+    return {
+        verb: any(
+            _rule_allows(rule, verb, resource)
+            for rule in res.status.resource_rules or []
+        )
+        for verb in RBAC_VERBS
+    }
+
+
+@click.pass_context
+def _access_reviews(ctx, resource):
+    '''
+    return: dict of {verb: allowed} from concurrent SelfSubjectAccessReviews
+    '''
+
+    def review(action):
 
         access_review_secret_spec = K.client.V1SelfSubjectAccessReviewSpec(
             resource_attributes={
                 "namespace": ctx.params['namespace'],
                 "verb": action,
-                "resource": kind.lower(),
+                "resource": resource,
             }
         )
 
-
         access_review_secret = K.client.V1SelfSubjectAccessReview(
             api_version='authorization.k8s.io/v1',
             kind="SelfSubjectAccessReview",
@@ -51,10 +405,61 @@ def check_rbac(ctx, kind):
             status={"allowed": False}
         )
 
+        res = auth_api().create_self_subject_access_review(
+            body=access_review_secret
+        )
+
+        return action, res.status.allowed
+
+    return dict(concurrent_map(review, RBAC_VERBS, max_workers=len(RBAC_VERBS)))
+
+
+@click.pass_context
+def _rbac_identity(ctx):
+    '''
+    stable, non-secret identifier for the AWS principal the kube token is
+    minted for (no STS call)
+    '''
+
+    if ctx.params.get('assume_role'):
+        return hashlib.sha256(ctx.params['assume_role'].encode('utf-8')).hexdigest()[:16]
+
+    return credential_identity(ctx.obj.mc)
+
+
+@click.pass_context
+def check_rbac(ctx, kind):
+    '''
+    kind: Kubernetes object _kind_ (e.g.: deployment, daemonset, secret, etc)
+
+    verbs are evaluated locally against one SelfSubjectRulesReview for the
+    namespace, falling back to concurrent SelfSubjectAccessReviews when the
+    rules review is incomplete.  grants are reused for RBAC_CACHE_TTL
+    seconds per (identity, cluster, namespace, resource); on disk as well
+    with --cache
+    '''
+
+    resource = kind.lower()
+    namespace = ctx.params['namespace']
+
+    cache_key = '\0'.join(
+        (_rbac_identity(), ctx.params['cluster_name'], namespace, resource)
+    )
+
+    with ctx.obj.rbac_lock:
+        if ctx.obj.rbac is None:
+            ctx.obj.rbac = dict()
+
+            if ctx.obj.use_cache:
+                ctx.obj.rbac = cache.load('rbac', 'reviews')[0] or dict()
+
+        entry = ctx.obj.rbac.get(cache_key)
+
+    if entry and time.time() - entry['cached'] < RBAC_CACHE_TTL:
+        allowed = entry['allowed']
+    else:
         try:
-            res = ctx.obj.kauthv1.create_self_subject_access_review(
-                body=access_review_secret
-            )
+            allowed = _rules_review(resource) or _access_reviews(resource)
         except K.client.ApiException:
             emit_error(
                 '{} is not authorized for connection with {}'.format(
@@ -66,12 +471,30 @@ def check_rbac(ctx, kind):
             )
             return False
 
-        if not res.status.allowed:
+        # only grants are reused; a denial is re-checked on the next run
+        if all(allowed.values()):
+            now = time.time()
+
+            with ctx.obj.rbac_lock:
+                ctx.obj.rbac = {
+                    k: v for k, v in ctx.obj.rbac.items()
+                    if now - v['cached'] < RBAC_CACHE_TTL
+                }
+                ctx.obj.rbac[cache_key] = {'allowed': allowed, 'cached': now}
+
+                if ctx.obj.use_cache:
+                    cache.store('rbac', ctx.obj.rbac, 'reviews')
+
+    retval = True
+
+    for action in RBAC_VERBS:
+
+        if not allowed[action]:
             emit_error(
                 "{} {} in namespace, {}, not authorized".format(
                     action,
                     kind.title(),
-                    ctx.params['namespace'],
+                    namespace,
                 ),
                 force=True,
                 color="magenta"
@@ -83,7 +506,7 @@ def check_rbac(ctx, kind):
                 "{} {} in namespace, {}, authorized".format(
                     action,
                     kind,
-                    ctx.params['namespace']
+                    namespace
                 ),
                 color="green"
             )
@@ -6,50 +6,172 @@ import re
 import os
 from io import StringIO
 import logging
+import threading
 
 from collections import defaultdict
 
-from .util import emit_error, get_eks_token
+from .util import (
+    emit_error, emit_summary, DEFAULT_MAX_CONCURRENCY, SECRET_LAYOUTS,
+    WATCH_INTERVAL, WATCH_RESYNC, BATCH_JOBS
+)
+from .clients import ClientFactory, parse_api_rate
 import env_kube_sps.sps as sps
-import env_kube_sps.eks as eks
 import env_kube_sps.kms as kms
+import env_kube_sps.cache as cache
+import env_kube_sps.apitrace as apitrace
 
 import click
-import boto3
+
+
+# Ctx attributes shared by every environment/component of a `batch` run
+SHARED_STATE = (
+    'use_cache',
+    'cache_dir',
+    'cache_ttl',
+    'credentials',
+    'trace',
+    'clients',
+    'kms_aliases',
+    'kms_lock',
+    'eks_clusters',
+    'kube_clients',
+    'kube_locks',
+)
+
 
 class Ctx:
     '''
     Context Data Container Class
     '''
 
-    def __init__(self):
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY):
         self.parameters = dict()
         self.parameter_history = dict()
         self.parameter_labels = set()
         self.kms_aliases = list()
+        self.kms_lock = threading.Lock()
         self.eks_clusters = dict()
-
-        self.mc = boto3.Session()
-
-        self.kms = self.mc.client('kms')
-        self.ssm = self.mc.client('ssm')
-        self.eks = self.mc.client('eks')
-        self.sts = self.mc.client('sts')
+        self.rbac = None
+        self.rbac_lock = threading.Lock()
+        self.kube_clients = dict()
+        self.kube_locks = dict()
+        self.max_concurrency = max_concurrency
+        self.use_cache = False
+        self.cache_dir = cache.default_cache_dir()
+        self.cache_ttl = cache.DEFAULT_CACHE_TTL
+        self.credentials = cache.CredentialCache()
         self.sps_prefix = str()
         self.keyid = str()
+        self.trace = None
+        self.clients = ClientFactory(max_concurrency=max_concurrency)
+
+    def select(self, environment, component):
+        '''
+        point this context at the _environment_/_component_ parameter set
+        '''
+
+        self.kms_alias = 'alias/{}/ssm'.format(environment)
+        self.sps_prefix = '/{}/{}'.format(environment, component)
+
+    def for_component(self, environment, component):
+        '''
+        return: a new Ctx for _environment_/_component_ sharing this run's
+          AWS clients and rate limits, caches, credentials, KMS alias
+          lookup and kubernetes clients (see `batch`)
+        '''
+
+        obj = Ctx(max_concurrency=self.max_concurrency)
+
+        for name in SHARED_STATE:
+            setattr(obj, name, getattr(self, name))
+
+        obj.select(environment, component)
+        obj.main = dict(self.main, environment=environment, component=component)
+
+        return obj
+
+    @property
+    def mc(self):
+        return self.clients.session
+
+    @property
+    def kms(self):
+        return self.clients.client('kms')
+
+    @property
+    def ssm(self):
+        return self.clients.client('ssm')
+
+    @property
+    def eks(self):
+        return self.clients.client('eks')
+
+    @property
+    def sts(self):
+        return self.clients.client('sts')
 
 
 @click.group()
-@click.option('--environment', envvar='BOVISYNC_ENVIRONMENT', required=True)
-@click.option('--component', envvar='BOVISYNC_COMPONENT', required=True)
+@click.option('--environment', envvar='BOVISYNC_ENVIRONMENT',
+              help='required, except by batch')
+@click.option('--component', envvar='BOVISYNC_COMPONENT',
+              help='required, except by batch')
 @click.option('-v', '--verbose', is_flag=True, default=False)
+@click.option('--max-concurrency', envvar='BOVISYNC_MAX_CONCURRENCY',
+              type=click.IntRange(min=1), default=DEFAULT_MAX_CONCURRENCY,
+              show_default=True,
+              help='upper bound on concurrent AWS API calls')
+@click.option('--cache/--no-cache', 'use_cache', envvar='BOVISYNC_CACHE',
+              default=False, help='keep an encrypted on-disk parameter cache')
+@click.option('--cache-dir', envvar='BOVISYNC_CACHE_DIR',
+              type=click.Path(file_okay=False),
+              default=cache.default_cache_dir, show_default=True)
+@click.option('--cache-ttl', envvar='BOVISYNC_CACHE_TTL',
+              type=click.IntRange(min=0), default=cache.DEFAULT_CACHE_TTL,
+              show_default=True, help='seconds before a full cache rebuild')
+@click.option('--credential-cache/--no-credential-cache',
+              envvar='BOVISYNC_CREDENTIAL_CACHE', default=False,
+              help='reuse EKS tokens and assumed-role credentials across runs')
+@click.option('--api-rate', envvar='BOVISYNC_API_RATE', multiple=True,
+              metavar='<SERVICE>[.<Operation>]=<TPS>',
+              help='hold AWS calls to a rate shared by every thread (e.g. ssm=40)')
+@click.option('--trace-api', is_flag=True, default=False,
+              help='time every AWS/kubernetes API call; JSON summary on stderr')
 @click.pass_context
-def main(ctx, environment, component, verbose):  # , update, set_key, input_file):
+def main(ctx, environment, component, verbose, max_concurrency,
+         use_cache, cache_dir, cache_ttl, credential_cache, api_rate, trace_api):
+
+    # batch takes environment/component pairs from its manifest
+    if ctx.invoked_subcommand != 'batch':
+        for param in ctx.command.params:
+            if param.name in ('environment', 'component') and not ctx.params[param.name]:
+                raise click.MissingParameter(ctx=ctx, param=param)
+
+    ctx.obj = Ctx(max_concurrency=max_concurrency)
+    ctx.obj.use_cache = use_cache
+    ctx.obj.cache_dir = cache_dir
+    ctx.obj.cache_ttl = cache_ttl
+    ctx.obj.credentials = cache.CredentialCache(persist=credential_cache)
+
+    for el in api_rate:
+        limit = parse_api_rate(el)
+
+        if limit is None:
+            raise click.BadParameter(
+                'expected <SERVICE>[.<Operation>]=<TPS>', param_hint='--api-rate'
+            )
+
+        service, operation, rate = limit
+        ctx.obj.clients.limit(service, rate, operation)
 
-    ctx.obj = Ctx()
+    ctx.call_on_close(ctx.obj.clients.report)
 
-    ctx.obj.kms_alias = 'alias/{}/ssm'.format(environment)
-    ctx.obj.sps_prefix = '/{environment}/{component}'.format(**ctx.params)
+    if trace_api:
+        ctx.obj.trace = apitrace.ApiTrace()
+        ctx.obj.clients.trace = ctx.obj.trace
+        ctx.call_on_close(ctx.obj.trace.emit)
+
+    ctx.obj.select(environment, component)
 
     ctx.obj.main = ctx.params
 
@@ -62,32 +184,53 @@ def main(ctx, environment, component, verbose):  # , update, set_key, input_file
 @click.option('--input-file', type=click.File('r'))
 @click.option('--with-label', default='staged')
 @click.option('--secret', default=True, type=bool)
+@click.option('--high-throughput', is_flag=True, default=False,
+              help='account has Parameter Store higher throughput enabled')
+@click.option('--tps', type=click.FloatRange(min=0.1), default=None,
+              help='PutParameter calls/second (default: 3, 10 with --high-throughput)')
+@click.option('--plan', is_flag=True, default=False,
+              help='show what would be created/updated and exit')
 @click.pass_context
-def sync_to_sps(ctx, update, set_key, input_file, with_label, secret):
+def sync_to_sps(ctx, update, set_key, input_file, with_label, secret,
+                high_throughput, tps, plan):
 
     if (secret and kms.preflight()):
         ctx.meta['keyid'] = ctx.obj.keyid
 
     if sps.preflight():
         sps.ingest()
-        sps.sync()
+
+        if plan:
+            sps.show_plan()
+        else:
+            results = sps.sync()
+            emit_summary(results)
+
+            if [el for el in results if el[1] == 'failed']:
+                ctx.exit(1)
 
 @main.command()
 @click.confirmation_option(prompt='Confirm')
 @click.option('-e', '--regex', help='applies only to rightmost sps path element')
-def purge_sps(regex):
+@click.option('--tps', type=click.FloatRange(min=0.1), default=None,
+              help='DeleteParameters calls/second (10 names per call; default: 3)')
+def purge_sps(regex, tps):
 
     sps.purge()
 
 @main.command()
 @click.option('--regex', default='.*$', help='applies only to rightmost sps path element')
+@click.option('--sort/--no-sort', default=True,
+              help='--no-sort prints names as they are listed')
 @click.pass_context
-def list_sps(ctx, regex):
+def list_sps(ctx, regex, sort):
 
     param_prefix = '/{environment}/{component}'.format(**ctx.parent.params)
     rex = re.compile(r'^{}/({})'.format(param_prefix, regex), re.I)
-    parameters = sps.parameters_list(param_prefix)
-    parameters.sort()
+    parameters = sps.parameter_names(param_prefix)
+
+    if sort:
+        parameters = sorted(parameters)
 
     [
         emit_error(el.split('/')[-1], force=True)
@@ -97,14 +240,92 @@ def list_sps(ctx, regex):
 
 
 @main.command()
-@click.option('-c', '--cluster-name', required=True)
-@click.option('-n', '--namespace', envvar='KUBE_NAMESPACE', required=True)
+@click.option('-l', '--label', help='list the parameter versions carrying this label')
+@click.pass_context
+def list_labels(ctx, label):
+
+    if label:
+        [
+            emit_error('{}:{}'.format(name, version), force=True)
+            for name, version in sps.labeled_parameters(label)
+        ]
+    else:
+        [
+            emit_error(el, force=True)
+            for el in sorted(sps.parameter_labels_list())
+        ]
+
+
+@main.command()
+@click.option('--all', 'everything', is_flag=True, default=False,
+              help='remove every cached document, not just this prefix')
+@click.pass_context
+def invalidate_cache(ctx, everything):
+
+    if everything:
+        removed = cache.invalidate()
+    else:
+        removed = cache.invalidate('versions', ctx.obj.sps_prefix)
+        removed.extend(cache.invalidate('labels', '/'))
+
+    [
+        emit_error('{} removed'.format(el), color="magenta")
+        for el in removed
+    ]
+
+    emit_error('{} cache documents removed'.format(len(removed)), force=True)
+
+
+@main.command()
+@click.option('-c', '--cluster-name', multiple=True)
+@click.option('-n', '--namespace', envvar='KUBE_NAMESPACE', multiple=True)
+@click.option('-t', '--target', multiple=True, metavar='<CLUSTER>/<NAMESPACE>',
+              help='cluster/namespace pair (repeatable)')
 @click.option('-r', '--assume-role', required=False)
 @click.option('--with-label', multiple=True, required=False)
+@click.option('--layout', type=click.Choice(SECRET_LAYOUTS), default='env', show_default=True,
+              help='env: one K=V `environment` key; keys: one data key per parameter')
+@click.option('--compress', is_flag=True, default=False,
+              help='gzip secret values (recorded in the shard manifest)')
+@click.option('--watch', is_flag=True, default=False,
+              help='keep running; push changes as they land in SSM')
+@click.option('--interval', type=click.IntRange(min=1), default=WATCH_INTERVAL, show_default=True,
+              help='--watch: seconds between SSM polls')
+@click.option('--resync', type=click.IntRange(min=1), default=WATCH_RESYNC, show_default=True,
+              help='--watch: seconds between full re-renders')
+@click.option('--iterations', type=click.IntRange(min=1), default=None, hidden=True,
+              help='--watch: stop after this many polls')
 @click.pass_context
-def sync_to_eks(ctx, cluster_name, namespace, assume_role, with_label):
+def sync_to_eks(ctx, cluster_name, namespace, target, assume_role, with_label,
+                layout, compress, watch, interval, resync, iterations):
+    '''
+    every --cluster-name is paired with every --namespace; use --target for
+    explicit pairs
+    '''
+
+    # kubernetes is only imported by the commands that talk to a cluster
+    import env_kube_sps.eks as eks
+
+    if [el for el in target if len(el.split('/')) != 2]:
+        raise click.BadParameter('expected <CLUSTER>/<NAMESPACE>', param_hint='--target')
 
-    if not eks.preflight():
+    if not eks.targets():
+        raise click.UsageError(
+            '--target or both --cluster-name and --namespace are required'
+        )
+
+    ctx.obj.sps_prefix = ctx.find_root().obj.sps_prefix
+
+    if watch:
+        try:
+            results = eks.watch(interval, resync, iterations)
+        except KeyboardInterrupt:
+            sys.exit(0)
+    else:
+        results = eks.sync()
+        emit_summary(results)
+
+    if [el for el in results if el[1:] == ('failed', 'preflight')]:
         emit_error(
             '''
             EKS preflight checks did not succeed. Please re-run using --verbose
@@ -115,6 +336,29 @@ def sync_to_eks(ctx, cluster_name, namespace, assume_role, with_label):
         )
         sys.exit(2)
 
-    ctx.obj.sps_prefix = ctx.find_root().obj.sps_prefix
+    if [el for el in results if el[1] == 'failed']:
+        sys.exit(1)
+
+
+@main.command(name='batch')
+@click.argument('manifest', type=click.File('r'))
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=BATCH_JOBS,
+              show_default=True, help='manifest entries run at a time')
+@click.pass_context
+def run_batch(ctx, manifest, jobs):
+    '''
+    sync every environment/component of a JSON manifest (see README) in
+    one run, sharing AWS clients, rate limits and kubernetes clients.
+    --environment/--component set the default for entries without their
+    own
+    '''
+
+    # loaded on use (it brings in eks for its error types), keeping startup lean
+    import env_kube_sps.batch as batch
+
+    results = batch.run(batch.load_manifest(manifest), jobs)
+
+    emit_summary(results)
 
-    eks.sync()
+    if [el for el in results if el[1] == 'failed']:
+        ctx.exit(1)
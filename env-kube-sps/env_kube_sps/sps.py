@@ -1,14 +1,181 @@
 
+import heapq
+import itertools
+import random
 import re
+import threading
 import time
 
 import click
+import env_kube_sps.apitrace as apitrace
+import env_kube_sps.cache as cache
 import env_kube_sps.kms as kms
-from .util import emit_error, dict2tags, pretty, KEY_VALUE_REX, chunk_sequence
+from .util import (
+    emit_error, dict2tags, pretty, KEY_VALUE_REX, chunk_sequence, chunk_iterable,
+    concurrent_map, emit_summary
+)
 from botocore.exceptions import ClientError
 
 
+# parameter label naming rules: no leading digit, `aws` or `ssm` prefix
+LABEL_REX = re.compile(r'^(?!aws|ssm|\d)[\w.-]{1,100}$', re.I)
+
+# shell-provided variables never imported from env files
+AUTO_VARS = (
+    'LANG',
+    'LOGNAME',
+    'HOME',
+    'PATH',
+    'TZ',
+    'USER',
+    'SHELL'
+)
+
+# PutParameter transactions/second: default and "higher throughput" quotas
+PUT_PARAMETER_TPS = 3
+PUT_PARAMETER_TPS_HIGH = 10
+
+# seconds allowed for a new version to become labelable, and the retry
+# backoff applied while waiting
+LABEL_DEADLINE = 60
+LABEL_BACKOFF_BASE = 0.1
+LABEL_BACKOFF_CAP = 5.0
+
+# DeleteParameters transactions/second (10 names per call)
+DELETE_PARAMETERS_TPS = 3
+
+CACHE_FIELDS = ('Name', 'Type', 'Value', 'Version', 'ARN', 'DataType')
+
+LABEL_FILTER_ERRORS = (
+    'InvalidFilterKey',
+    'InvalidFilterOption',
+    'InvalidFilterValue',
+    'ValidationException',
+)
+
+
+def _describe_parameters(ssm, param_path, begins_with=None):
+    '''
+    generator of parameter metadata (name, version, modification time; no
+    values) for parameters under _param_path_, optionally restricted to
+    names starting with _begins_with_.  pages are yielded as they arrive
+    '''
+
+    args = {'MaxResults': 50}
+    filters = []
+
+    if param_path.rstrip('/'):
+        filters.append(
+            {'Key': 'Path', 'Option': 'Recursive', 'Values': [param_path]}
+        )
+
+    if begins_with:
+        filters.append(
+            {'Key': 'Name', 'Option': 'BeginsWith', 'Values': [begins_with]}
+        )
+
+    if filters:
+        args['ParameterFilters'] = filters
+
+    while True:
+        res = ssm.describe_parameters(**args)
+
+        for param in res['Parameters']:
+            yield param
+
+        if res.get('NextToken', None):
+            args['NextToken'] = res['NextToken']
+        else:
+            break
+
+
+def _cache_entry(param):
+
+    entry = {k: param[k] for k in CACHE_FIELDS if k in param}
+    entry['LastModifiedDate'] = param['LastModifiedDate'].timestamp()
+
+    return entry
+
+
 @click.pass_context
+def _parameter_versions(ctx, param_path, selected):
+    '''
+    args:
+      param_path: prefix the versions live under (names the cache document)
+      selected: iterable of tuple(name, version, last modified), the last
+        modified date as epoch seconds
+
+    return: dict of {(name, version): parameter}
+
+    side-effects:
+      with --cache decrypted versions are kept in a sealed on-disk document
+      keyed by name and version.  a parameter that is deleted and recreated
+      starts again at version 1, so an entry is only used while its last
+      modified date matches; versions missing from the document (or stale
+      in it) are fetched (as `name:version` selectors) and decrypted
+    '''
+
+    ssm = ctx.obj.ssm
+
+    cached, created = cache.load(
+        'versions', param_path, ttl=ctx.obj.cache_ttl, sealed=True
+    )
+
+    if cached is None:
+        cached = dict()
+
+    modified = {
+        '{}:{}'.format(name, version): stamp for name, version, stamp in selected
+    }
+    selectors = sorted(modified)
+    missing = [
+        el for el in selectors
+        if cached.get(el, dict()).get('LastModifiedDate') != modified[el]
+    ]
+
+    def fetch(batch):
+        return ssm.get_parameters(Names=batch, WithDecryption=True)['Parameters']
+
+    fresh = {
+        '{}:{}'.format(param['Name'], param['Version']): _cache_entry(param)
+        for params in concurrent_map(fetch, chunk_sequence(missing))
+        for param in params
+    }
+
+    emit_error(
+        '{}: {} parameter versions cached, {} decrypted'.format(
+            param_path, len(selectors) - len(missing), len(fresh)
+        )
+    )
+
+    cached.update(fresh)
+
+    if fresh or created is None:
+        cache.store(
+            'versions', cached, param_path, created=created, sealed=True
+        )
+
+    return {
+        (cached[el]['Name'], cached[el]['Version']): cached[el]
+        for el in selectors
+        if el in cached
+    }
+
+
+@click.pass_context
+def parameter_names(ctx, param_path, begins_with=None):
+    '''
+    generator of the names of parameters under _param_path_ (see
+    _describe_parameters()).  values are never requested, so nothing is
+    decrypted and nothing is added to ctx.obj.parameters
+    '''
+
+    for param in _describe_parameters(ctx.obj.ssm, param_path, begins_with):
+        yield param['Name']
+
+
+@click.pass_context
+@apitrace.timed('fetch')
 def parameters_list(ctx, param_path, refresh=False):
     '''
     Capped at 10 elements/api-call, so, this.
@@ -35,89 +202,363 @@ def parameters_list(ctx, param_path, refresh=False):
     return [el for el in tuple(ctx.obj.parameters.keys()) if el.startswith('/')]
 
 
+def _fetch_parameter_history(ssm, param_path, decrypt=True):
+    '''
+    complete (paginated) version history for a single parameter.  does not
+    touch the click context so it is safe to call from worker threads
+    '''
+
+    args = {'Name': param_path, 'WithDecryption': decrypt}
+    history = []
+
+    while True:
+        res = ssm.get_parameter_history(**args)
+        history.extend(res['Parameters'])
+
+        if res.get('NextToken', None):
+            args['NextToken'] = res['NextToken']
+        else:
+            break
+
+    return history
+
+
 @click.pass_context
-def parameter_history(ctx, param_path, refresh=True):
+@apitrace.timed('history')
+def parameter_histories(ctx, param_paths, refresh=False):
+    '''
+    args:
+      param_paths: iterable of full parameter names
+      refresh: (bool) if True, re-fetch histories already held locally
 
-    if param_path in ctx.obj.parameters:
-        if param_path not in ctx.obj.parameter_history.keys():
+    return: dict of {param_path: [parameter versions]}
+
+    side-effects:
+      histories are retrieved concurrently (bounded by --max-concurrency)
+      and cached in ctx.obj.parameter_history
+    '''
 
-            args = {'Name': param_path}
-            args.update({'WithDecryption': True})
+    param_paths = [p for p in param_paths if p in ctx.obj.parameters]
 
-            while True:
-                try:
-                    res = ctx.obj.ssm.get_parameter_history(**args)
-                except ClientError as e:
-                    emit_error(e, force=True, color='red')
+    pending = [
+        p for p in param_paths
+        if refresh or p not in ctx.obj.parameter_history
+    ]
 
-                ctx.obj.parameter_history.update({param_path: res['Parameters']})
+    def fetch(param_path):
+        try:
+            return param_path, _fetch_parameter_history(ctx.obj.ssm, param_path)
+        except ClientError as e:
+            emit_error(
+                '{}: unable to retrieve history: {}'.format(param_path, e),
+                force=True,
+                color='red'
+            )
+            raise
 
-                if res.get('NextToken', None):
-                    args['nextToken'] = res['NextToken']
-                else:
-                    break
+    ctx.obj.parameter_history.update(concurrent_map(fetch, pending))
 
-    return ctx.obj.parameter_history[param_path]
+    return {p: ctx.obj.parameter_history[p] for p in param_paths}
 
 
 @click.pass_context
-def parameter_labels_list(ctx, refresh=False):
+def _label_index_entries(ctx):
+    '''
+    return: dict of {name: {'stamp': [version, modified], 'labels': {label: version}}}
+      for every parameter in the account
+
+    side-effects:
+      refreshes the on-disk label index (with --cache).  histories are
+      re-read (without decryption) only for parameters whose
+      Version/LastModifiedDate changed since they were indexed.
+    '''
+
+    ssm = ctx.obj.ssm
+
+    if ctx.obj.use_cache:
+        indexed, created = cache.load('labels', '/', ttl=ctx.obj.cache_ttl)
+    else:
+        indexed, created = None, None
+
+    if indexed is None:
+        indexed = dict()
 
-    if not ctx.obj.parameter_labels:
-        ctx.obj.parameter_labels = {
-            label
-            for p in parameters_list('/')
-            for pver in parameter_history(p)
-            if pver.get('Labels', [])
-            for label in pver['Labels']
+    current = {
+        param['Name']: [param['Version'], param['LastModifiedDate'].timestamp()]
+        for param in _describe_parameters(ssm, '/')
+    }
+
+    stale = [
+        name
+        for name, stamp in current.items()
+        if name not in indexed or indexed[name]['stamp'] != stamp
+    ]
+
+    def fetch(name):
+        labels = {
+            label: pver['Version']
+            for pver in _fetch_parameter_history(ssm, name, decrypt=False)
+            for label in pver.get('Labels', [])
         }
+        return name, {'stamp': current[name], 'labels': labels}
+
+    fresh = dict(concurrent_map(fetch, stale))
+    removed = set(indexed) - set(current)
+
+    entries = {
+        name: fresh.get(name, indexed.get(name))
+        for name in current
+        if name in fresh or name in indexed
+    }
+
+    emit_error(
+        'label index: {} parameters indexed, {} refreshed, {} removed'.format(
+            len(entries) - len(fresh), len(fresh), len(removed)
+        )
+    )
+
+    if ctx.obj.use_cache and (fresh or removed or created is None):
+        cache.store('labels', entries, '/', created=created)
+
+    return entries
+
+
+@click.pass_context
+def label_index(ctx, refresh=False):
+    '''
+    return: dict of {label: [(parameter name, version), ...]}
+
+    moving a label between existing versions changes no parameter
+    metadata, so the versions here can trail such moves until the index
+    is rebuilt.  use labeled_parameters() for the versions carrying a label
+    '''
+
+    if refresh or not getattr(ctx.obj, 'label_index', None):
+        index = dict()
+
+        for name, entry in sorted(_label_index_entries().items()):
+            for label, version in entry['labels'].items():
+                index.setdefault(label, []).append((name, version))
+
+        ctx.obj.label_index = index
+
+    return ctx.obj.label_index
+
+
+@click.pass_context
+def parameter_labels_list(ctx, refresh=False):
+
+    if refresh or not ctx.obj.parameter_labels:
+        ctx.obj.parameter_labels = set(label_index(refresh=refresh))
 
     return ctx.obj.parameter_labels
 
 
 @click.pass_context
-def parameters_by_label(ctx, labels, refresh=False):
+def labeled_parameters(ctx, label):
+    '''
+    return: sorted list of tuple(parameter name, version) for the versions
+      in the account carrying _label_
 
-    param_path = ctx.obj.sps_prefix
+    resolved from SSM on every call (DescribeParameters, then undecrypted
+    `name:label` GetParameters, 10 names per call) rather than from the
+    label index, which cannot see label moves
+    '''
 
-    retval = [
+    return sorted(
+        (name, version)
+        for name, version, _ in _labeled_versions(list(parameter_names('/')), label)
+    )
+
+
+def _labeled_parameter_names(ssm, param_path, label):
+    '''
+    names of the parameters under _param_path_ carrying _label_, resolved
+    server-side with a `Label` parameter filter.  values are not decrypted
+    '''
+
+    args = {
+        'Path': param_path,
+        'Recursive': True,
+        'WithDecryption': False,
+        'ParameterFilters': [
+            {'Key': 'Label', 'Option': 'Equals', 'Values': [label]}
+        ],
+    }
+    names = []
+
+    while True:
+        res = ssm.get_parameters_by_path(**args)
+        names.extend(param['Name'] for param in res['Parameters'])
+
+        if res.get('NextToken', None):
+            args['NextToken'] = res['NextToken']
+        else:
+            break
+
+    return names
+
+
+@click.pass_context
+def _labeled_versions(ctx, names, label):
+    '''
+    return: list of tuple(name, version, last modified) for the versions
+      of _names_ carrying _label_ (`name:label` selectors), the last
+      modified date as epoch seconds.  values are not decrypted
+    '''
+
+    ssm = ctx.obj.ssm
+
+    def fetch(batch):
+        return ssm.get_parameters(
+            Names=['{}:{}'.format(name, label) for name in batch],
+            WithDecryption=False
+        )['Parameters']
+
+    return [
+        (param['Name'], param['Version'], param['LastModifiedDate'].timestamp())
+        for params in concurrent_map(fetch, chunk_sequence(names))
+        for param in params
+    ]
+
+
+@click.pass_context
+def _parameters_by_label_filter(ctx, param_path, label):
+    '''
+    labeled parameter versions via the `Label` filter.  values are read
+    back with `name:label` selectors so each one is pinned to the labeled
+    version rather than whatever version the path filter matched on.
+    with --cache, labeled versions are resolved without decryption and
+    their values come from the version cache (see _parameter_versions())
+    '''
+
+    ssm = ctx.obj.ssm
+    names = _labeled_parameter_names(ssm, param_path, label)
+
+    if ctx.obj.use_cache:
+        return [
+            dict(param, Labels=[label])
+            for param in _parameter_versions(
+                param_path, _labeled_versions(names, label)
+            ).values()
+        ]
+
+    def fetch(batch):
+        return ssm.get_parameters(
+            Names=['{}:{}'.format(name, label) for name in batch],
+            WithDecryption=True
+        )['Parameters']
+
+    return [
+        dict(param, Labels=[label])
+        for params in concurrent_map(fetch, chunk_sequence(names))
+        for param in params
+    ]
+
+
+@click.pass_context
+def _parameters_by_label_history(ctx, param_path, labels, refresh=False):
+    '''
+    labeled parameter versions found by walking the full version history
+    of every parameter under _param_path_.  with --cache, histories are
+    walked without decryption and values come from the version cache
+    '''
+
+    if ctx.obj.use_cache:
+        def fetch(name):
+            return _fetch_parameter_history(ctx.obj.ssm, name, decrypt=False)
+
+        labeled = [
+            pver
+            for history in concurrent_map(fetch, list(parameter_names(param_path)))
+            for pver in history
+            for l in labels      # noqa
+            if l in pver.get('Labels', [])
+        ]
+
+        versions = _parameter_versions(param_path, [
+            (pver['Name'], pver['Version'], pver['LastModifiedDate'].timestamp())
+            for pver in labeled
+        ])
+
+        return [
+            dict(versions[(pver['Name'], pver['Version'])], Labels=pver['Labels'])
+            for pver in labeled
+            if (pver['Name'], pver['Version']) in versions
+        ]
+
+    histories = parameter_histories(
+        parameters_list(param_path, refresh=refresh),
+        refresh=refresh
+    )
+
+    return [
         pver
-        for p in parameters_list(param_path, refresh=refresh)
-        for pver in parameter_history(p, refresh=refresh)
+        for history in histories.values()
+        for pver in history
         for l in labels      # noqa
-        if l in pver['Labels']
+        if l in pver.get('Labels', [])
     ]
 
-    return retval
 
 @click.pass_context
-def check_parameter(ctx, param_path, refresh=False):
+@apitrace.timed('fetch')
+def parameters_by_label(ctx, labels, refresh=False):
     '''
     args:
-      param_path: full name/path for SSM Parameter Store
-      refresh: (bool) if True, refresh local data for given parameter
+      labels: iterable of parameter labels
+      refresh: (bool) if True, refresh local data (history walk only)
+
+    return: list of parameter versions under ctx.obj.sps_prefix carrying
+      any of _labels_
 
-    return: (bool) True if present
-    possible side-effects:
-      cache unencrypted value in ctx.obj.parameters{} for comparing
-      submitted and stored values. (prevents creating a new parameter value
-      **version** when value unchanged)
+    labels are resolved with the server-side `Label` filter.  labels SSM
+    cannot store (e.g.: `K=V` secret labels sharing --with-label) match
+    nothing and are skipped; labels the endpoint's filter rejects fall back
+    to walking parameter histories.
     '''
-    ssm = ctx.obj.ssm
 
-    try:
-        if param_path not in ctx.obj.parameters.keys():
-            res = ssm.get_parameter(Name=param_path, WithDecryption=True)
-            ctx.obj.parameters.update({param_path: res['Parameter']})
+    param_path = ctx.obj.sps_prefix
 
-        return True
-    except ssm.exceptions.ParameterNotFound:
+    retval = []
+    walk = []
 
-        return False
+    for label in labels:
+        if not LABEL_REX.match(label):
+            emit_error('{}: not a parameter label, skipped'.format(label))
+            continue
+
+        try:
+            retval.extend(_parameters_by_label_filter(param_path, label))
+        except ClientError as e:
+            if e.response['Error']['Code'] not in LABEL_FILTER_ERRORS:
+                raise
+
+            emit_error(
+                '{}: label filter rejected ({}). Walking parameter histories...'.format(
+                    label, e.response['Error']['Code']
+                ),
+                color='yellow'
+            )
+            walk.append(label)
+
+    if walk:
+        retval.extend(_parameters_by_label_history(param_path, walk, refresh=refresh))
+
+    return retval
 
 
 @click.pass_context
+@apitrace.timed('write')
 def purge(ctx):
+    '''
+    delete the parameters matching --regex.  DeleteParameters batches (10
+    names each) are dispatched concurrently, held to --tps by the run's
+    shared DeleteParameters rate limit; botocore's adaptive retries handle
+    throttling.  names SSM reports as invalid and batches that fail
+    outright are collected into the closing summary rather than aborting
+    the purge.
+    '''
 
     pattern = ctx.params['regex']
     param_prefix = '/{environment}/{component}'.format(**ctx.parent.params)
@@ -126,145 +567,442 @@ def purge(ctx):
 
     params = [
         el
-        for el in parameters_list(param_prefix, refresh=True)
+        for el in parameter_names(param_prefix)
         if rex.search(el)
     ]
 
-    try:
-        for batch in chunk_sequence(params):
-            ctx.obj.ssm.delete_parameters(Names=batch)
+    ctx.obj.clients.limit(
+        'ssm', ctx.params['tps'] or DELETE_PARAMETERS_TPS, 'DeleteParameters'
+    )
+
+    def delete_batch(batch):
+        try:
+            res = ctx.obj.ssm.delete_parameters(Names=batch)
+        except ClientError as e:
+            emit_error(e, force=True)
+            return [(el, 'failed', e.response['Error']['Code']) for el in batch]
+
+        return [
+            (el, 'deleted', '') for el in res.get('DeletedParameters', [])
+        ] + [
+            (el, 'failed', 'invalid parameter') for el in res.get('InvalidParameters', [])
+        ]
+
+    results = sorted(
+        result
+        for batch_results in concurrent_map(delete_batch, chunk_sequence(params))
+        for result in batch_results
+    )
+
+    for el, result, _ in results:
+        if result == 'deleted':
+            ctx.obj.parameters.pop(el, None)
+
+    # a name recreated after the purge starts again at version 1
+    if any(result == 'deleted' for _, result, _ in results):
+        cache.invalidate('versions', param_prefix)
 
-        for el in params:
-            emit_error('{} deleted'.format(el), color="magenta", force=True)
-    except ctx.obj.ssm.exceptions.ClientError as e:
-        emit_error(e, force=True)
+    emit_summary(results)
+
+    if any(result == 'failed' for _, result, _ in results):
         emit_error('failed deletion', color="yellow", force=True)
+        ctx.exit(1)
+
+
+def _parse_env_lines(fh):
+    '''
+    generator of tuple(line number, key, value) for the `K=V` lines of an
+    env-formatted file, read one line at a time
+    '''
+
+    for lineno, el in enumerate(fh):
+        el = el.rstrip('\n')
+
+        if el and KEY_VALUE_REX.search(el):
+            for K, V in KEY_VALUE_REX.findall(el):
+                if K not in AUTO_VARS:
+                    yield lineno, K, V
 
 
 @click.pass_context
-def ingest(ctx):
+def _stream_env_file(ctx, fh):
+    '''
+    generator of tuple(key, value) from an env-formatted file
 
-    AUTO_VARS = [
-        'LANG',
-        'LOGNAME',
-        'HOME',
-        'PATH',
-        'TZ',
-        'USER',
-        'SHELL'
-    ]
+    as with a shell, the last assignment of a key wins.  seekable files are
+    pre-scanned for the line of each key's last assignment (keys only, no
+    values are held); for pipes, later duplicates are reported and skipped
+    because the first one may already be on its way to SPS.
+    '''
 
-    if ctx.params['input_file']:
-        ctx.obj.raw = ctx.params['input_file'].read().split("\n")
+    last = None
 
-        ctx.obj.env_variables = {
-            K: V
-            for el in ctx.obj.raw
-            if el
-            and KEY_VALUE_REX.search(el)
-            for K, V in KEY_VALUE_REX.findall(el)
-            if K not in AUTO_VARS
-        }
-    else:
-        ctx.obj.raw = []
+    if fh.seekable():
+        start = fh.tell()
+        last = {K: lineno for lineno, K, _ in _parse_env_lines(fh)}
+        fh.seek(start)
+
+    seen = set()
+
+    for lineno, K, V in _parse_env_lines(fh):
+        if last is not None:
+            if last[K] != lineno:
+                continue
+        elif K in seen:
+            emit_error(
+                '{}: duplicate assignment on line {} ignored'.format(K, lineno + 1),
+                force=True,
+                color="yellow"
+            )
+            continue
+        else:
+            seen.add(K)
+
+        yield K, V
+
+
+@click.pass_context
+def ingest(ctx):
+    '''
+    side-effects:
+      ctx.obj.env_variables is set to a generator of tuple(key, value).
+      input files are parsed lazily, as the write stage consumes them
+    '''
 
-        ctx.obj.env_variables = {
+    if ctx.params['input_file']:
+        variables = _stream_env_file(ctx.params['input_file'])
+    else:
+        variables = iter({
             K: V
             for el in ctx.params['set_key']
             for K, V in KEY_VALUE_REX.findall(el)
+        }.items())
+
+    def counted():
+        count = 0
+
+        for el in variables:
+            count += 1
+            yield el
+
+        emit_error('{} variables ingested'.format(count), force=True)
+
+    ctx.obj.env_variables = counted()
+
+
+@click.pass_context
+def plan_parameters(ctx, items):
+    '''
+    args:
+      items: iterable of tuple(key, value)
+
+    return: generator of tuple(key, value, param_path, action) where
+      action is one of: create, skip (exists and --update=False),
+      unchanged, update
+
+    existing parameters are resolved with GetParameters, 10 names per call.
+    _items_ is consumed lazily
+    '''
+
+    ssm = ctx.obj.ssm
+    update = ctx.params['update']
+
+    @apitrace.timed('fetch')
+    def resolve(batch):
+        paths = ['{}/{}'.format(ctx.obj.sps_prefix, K) for K, _ in batch]
+
+        found = {
+            param['Name']: param
+            for param in ssm.get_parameters(
+                Names=paths, WithDecryption=True
+            )['Parameters']
         }
 
-    emit_error(
-        '{} variables ingested'.format(len(ctx.obj.env_variables)),
-        force=True
-    )
+        retval = []
+
+        for (K, V), param_path in zip(batch, paths):
+            if param_path not in found:
+                action = 'create'
+            elif not update:
+                action = 'skip'
+            elif V == found[param_path]['Value']:
+                action = 'unchanged'
+            else:
+                action = 'update'
+
+            retval.append((K, V, param_path, action))
+
+        return retval
+
+    for planned in concurrent_map(resolve, chunk_iterable(items)):
+        for el in planned:
+            yield el
+
 
 @click.pass_context
-def sync(ctx):
+def show_plan(ctx):
+    '''
+    emit the create/update/unchanged/skip plan for the ingested keys
+    without writing anything
     '''
-    args: (none)
-    returns: (none)
 
-    side-effects:
-      store and tag ingested key/value pairs in SSM parameter store
-      using he pattern `/[environment]/[component]/[Key Name]
+    details = {
+        'create': 'not found',
+        'skip': 'exists and --update=False',
+        'update': 'value differs',
+    }
+
+    emit_summary(sorted(
+        (param_path, action, details.get(action, ''))
+        for _, _, param_path, action in plan_parameters(ctx.obj.env_variables)
+    ))
+
+
+class Labeler(object):
+    '''
+    deferred labeling stage for sync()
+
+    put workers submit (name, version) pairs as soon as PutParameter
+    returns; a background thread applies the labels in batches of whatever
+    is due.  versions SSM has not made visible yet (ParameterNotFound,
+    ParameterVersionNotFound) are re-queued with jittered exponential
+    backoff until _deadline_ seconds after submission.
+    '''
+
+    RETRY_ERRORS = ('ParameterNotFound', 'ParameterVersionNotFound')
 
+    def __init__(self, ssm, labels, deadline=LABEL_DEADLINE):
+        self._ssm = ssm
+        self._labels = list(labels)
+        self._deadline = deadline
+        self._pending = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self.failures = dict()
+
+        self._phase = apitrace.current_phase()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, name, version):
+
+        now = time.monotonic()
+
+        with self._cond:
+            heapq.heappush(
+                self._pending,
+                (now, next(self._seq), name, version, 0, now + self._deadline)
+            )
+            self._cond.notify()
+
+    def close(self):
+        '''
+        wait for outstanding labels
+
+        return: dict of {name: error code} for versions left unlabeled
+        '''
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+        self._thread.join()
+
+        return self.failures
+
+    def _next_batch(self):
+
+        with self._cond:
+            while True:
+                now = time.monotonic()
+
+                if self._pending and self._pending[0][0] <= now:
+                    batch = []
+                    while self._pending and self._pending[0][0] <= now:
+                        batch.append(heapq.heappop(self._pending))
+                    return batch
+
+                if self._closed and not self._pending:
+                    return None
+
+                self._cond.wait(
+                    self._pending[0][0] - now if self._pending else None
+                )
+
+    def _run(self):
+
+        with apitrace.inherit(self._phase):
+            while True:
+                batch = self._next_batch()
+
+                if batch is None:
+                    break
+
+                for _, seq, name, version, attempt, expires in batch:
+                    self._label(seq, name, version, attempt, expires)
+
+    def _label(self, seq, name, version, attempt, expires):
+
+        try:
+            self._ssm.label_parameter_version(
+                Name=name,
+                ParameterVersion=version,
+                Labels=self._labels
+            )
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            now = time.monotonic()
+
+            if code not in self.RETRY_ERRORS or now >= expires:
+                self.failures[name] = code
+                return
+
+            delay = min(LABEL_BACKOFF_CAP, LABEL_BACKOFF_BASE * 2 ** attempt)
+            due = min(expires, now + random.uniform(delay / 2, delay))
+
+            with self._cond:
+                heapq.heappush(
+                    self._pending, (due, seq, name, version, attempt + 1, expires)
+                )
+        except Exception as e:  # pylint: disable=broad-except
+            # anything else (e.g.: EndpointConnectionError) fails this
+            # version only; the thread keeps labeling the rest
+            self.failures[name] = e.__class__.__name__
+
+
+@click.pass_context
+def _sync_parameter(ctx, planned, labeler):
+    '''
+    args:
+      planned: tuple(key, value, param_path, action) from plan_parameters()
+      labeler: Labeler receiving newly written versions
+
+    return: tuple(param_path, result, detail)
+
+    store and label a single ingested key/value pair.  runs in a worker
+    thread (see sync())
     '''
+    K, V, param_path, action = planned
+
     ssm = ctx.obj.ssm
     component = ctx.obj.main['component']
     env = ctx.obj.main['environment']
-    update = ctx.params['update']
     is_secret = ctx.params['secret']
 
-    path_prefix = ctx.obj.sps_prefix
+    kwargs = {}
 
-    for K, V in ctx.obj.env_variables.items():
+    tags = dict2tags({
+        'Name': K,
+        'component': component,
+        'environment': env,
+        'Managed-By': 'env-kube-sps'
+    })
 
-        kwargs = {}
+    if action != 'create':
+        emit_error('{} found'.format(param_path), color="green")
 
-        param_path = '{}/{}'.format(path_prefix, K)
+        if action == 'skip':
+            emit_error('{}: exists and --update=False'.format(param_path))
+            return param_path, 'skipped', 'exists and --update=False'
+        elif action == 'unchanged':
+            emit_error('{}: unchanged.  Skipping...'.format(param_path))
+            return param_path, 'unchanged', ''
+        else:
+            emit_error('Updating {}...'.format(param_path), force=True)
+            kwargs.update({'Overwrite': True})
+            result = 'updated'
+    else:
+        emit_error(
+            '{} not found. Creating...'.format(param_path),
+            color="green",
+            force=True
+        )
+        kwargs.update({'Tags': tags})
+        result = 'created'
 
-        tags = dict2tags({
-            'Name': K,
-            'component': component,
-            'environment': env,
-            'Managed-By': 'env-kube-sps'
+    kwargs.update({
+        'Name': param_path,
+        'Value': V,
+    })
+
+    if is_secret:
+        kwargs.update({
+            'Type': 'SecureString',
+            'KeyId': ctx.obj.keyid
+        })
+    else:
+        kwargs.update({
+            'Type': 'String'
         })
 
-        if check_parameter(param_path):
-            emit_error('{} found'.format(param_path), color="green")
+    if len(V) > 4096:
+        kwargs.update({
+            'Tier': 'Advanced'
+        })
 
-            if not update:
-                emit_error('{}: exists and --update=False'.format(param_path))
-                continue
-            else:
-                if V == ctx.obj.parameters[param_path]['Value']:
-                    emit_error('{}: unchanged.  Skipping...'.format(param_path))
-                    continue
+    res = ssm.put_parameter(**kwargs)
 
-                emit_error('Updating {}...'.format(param_path), force=True)
-                kwargs.update({'Overwrite': True})
-        else:
-            emit_error(
-                '{} not found. Creating...'.format(param_path),
-                color="green",
-                force=True
-            )
-            kwargs.update({'Tags': tags})
+    # ^ this isn't always ready by the time it returns, so labeling is
+    # deferred to the labeling stage
+    labeler.submit(param_path, res['Version'])
 
-        kwargs.update({
-            'Name': param_path,
-            'Value': V,
-        })
+    return param_path, result, 'version {}'.format(res['Version'])
 
-        if is_secret:
-            kwargs.update({
-                'Type': 'SecureString',
-                'KeyId': ctx.obj.keyid
-            })
-        else:
-            kwargs.update({
-                'Type': 'String'
-            })
 
-        if len(V) > 4096:
-            kwargs.update({
-                'Tier': 'Advanced'
-            })
+@click.pass_context
+@apitrace.timed('write')
+def sync(ctx):
+    '''
+    args: (none)
+    returns: sorted list of tuple(param_path, result, detail)
 
-        res = ssm.put_parameter(**kwargs)
+    side-effects:
+      store and tag ingested key/value pairs in SSM parameter store
+      using he pattern `/[environment]/[component]/[Key Name]
 
-        # ^ this isn't always ready by the time it returns, so...
-        while True:
-            try:
-                ssm.label_parameter_version(
-                    Name=param_path,
-                    ParameterVersion=res['Version'],
-                    Labels=(ctx.params['with_label'],)
-                )
-                break
-            except ssm.exceptions.ParameterNotFound:
-                time.sleep(0.1)
+    keys are written concurrently (--max-concurrency) with PutParameter
+    calls held to --tps by the run's shared PutParameter rate limit (see
+    clients.ClientFactory.limit()).  throttled calls are retried by
+    botocore (adaptive mode); other failures are returned per key for the
+    closing summary.
+    new versions are labeled by a Labeler running alongside the puts.
+    '''
+
+    tps = ctx.params['tps']
+
+    if tps is None:
+        tps = PUT_PARAMETER_TPS_HIGH if ctx.params['high_throughput'] else PUT_PARAMETER_TPS
+
+    ctx.obj.clients.limit('ssm', tps, 'PutParameter')
+    labeler = Labeler(ctx.obj.ssm, (ctx.params['with_label'],))
+
+    def sync_parameter(planned):
+        try:
+            return _sync_parameter(planned, labeler)
+        except ClientError as e:
+            param_path = planned[2]
+            emit_error('{}: {}'.format(param_path, e), force=True, color='red')
+            return param_path, 'failed', e.response['Error']['Code']
+
+    try:
+        written = list(concurrent_map(
+            sync_parameter,
+            plan_parameters(ctx.obj.env_variables)
+        ))
+    finally:
+        label_failures = labeler.close()
+
+    results = sorted(
+        (param_path, 'failed', '{}; labeling failed: {}'.format(
+            detail, label_failures[param_path]
+        ))
+        if param_path in label_failures
+        else (param_path, result, detail)
+        for param_path, result, detail in written
+    )
+
+    return results
 
 
 @click.pass_context
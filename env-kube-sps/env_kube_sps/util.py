@@ -1,14 +1,17 @@
 
 import base64
+import calendar
+import hashlib
 import json
 import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pprint import PrettyPrinter
 
 from datetime import datetime, timedelta
-from botocore.signers import RequestSigner
-from botocore.model import ServiceId
 
-import botocore
 import click
 
 
@@ -28,6 +31,32 @@ CLUSTER_NAME_HEADER = 'x-k8s-aws-id'
 
 KEY_VALUE_REX = re.compile(r'^\s*([^=]+)\s*=\s*(.+)\s*$')
 
+DEFAULT_MAX_CONCURRENCY = 8
+
+# sync-to-eks secret layouts: a single newline-joined K=V `environment` key,
+# or one data key per parameter
+SECRET_LAYOUTS = ('env', 'keys')
+
+# batch: manifest entries run at a time
+BATCH_JOBS = 4
+
+# sync-to-eks --watch: seconds between polls of parameter metadata
+WATCH_INTERVAL = 30
+
+# sync-to-eks --watch: seconds between full re-renders (catches label
+# moves, which do not change parameter metadata, and out-of-band edits to
+# the secret)
+WATCH_RESYNC = 600
+
+THROTTLE_ERROR_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'TooManyRequestsException',
+    'TooManyUpdates',
+    'RequestLimitExceeded',
+)
+
 
 @click.pass_context
 def secret_labels(ctx):
@@ -46,6 +75,20 @@ def secret_labels(ctx):
         for k, v in KEY_VALUE_REX.findall(el)
     }
 
+def credential_identity(session):
+    '''
+    return: stable, non-secret identifier for the credentials of a boto3 or
+      botocore _session_ (a digest of the access key id; no STS call)
+    '''
+
+    credentials = session.get_credentials()
+
+    if credentials is None:
+        return ''
+
+    return hashlib.sha256(credentials.access_key.encode('utf-8')).hexdigest()[:16]
+
+
 @click.pass_context
 def whoami(ctx):
 
@@ -75,6 +118,104 @@ def chunk_sequence(seq, limit=10):
         yield seq[top: el+limit]
         top += limit
 
+def chunk_iterable(iterable, limit=10):
+    '''
+    generator that yields lists of up to _limit_ elements from any iterable
+    (consumed lazily)
+    '''
+    chunk = []
+
+    for el in iterable:
+        chunk.append(el)
+
+        if len(chunk) == limit:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+class TokenBucket(object):
+    '''
+    thread-safe token bucket rate limiter
+
+    rate: (float) tokens added per second
+    capacity: (float) burst size (default: one second's worth of tokens)
+
+    `waited` accumulates the seconds callers have been held back
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, self.rate))
+        self.waited = 0.0
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        '''
+        block until _tokens_ are available, then take them
+        '''
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._stamp) * self.rate
+                )
+                self._stamp = now
+
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+
+                wait = (tokens - self._tokens) / self.rate
+                self.waited += wait
+
+            time.sleep(wait)
+
+
+@click.pass_context
+def concurrent_map(ctx, func, items, max_workers=None):
+    '''
+    generator that yields func(item) for each of _items_, in order, using
+    a bounded thread pool.
+
+    _items_ is consumed lazily and no more than 2x _max_workers_ calls are
+    in flight at any time.  the active click context (and --trace-api
+    phase) is pushed in each worker so `@click.pass_context` helpers
+    (emit_error, etc) work from inside _func_.
+    '''
+
+    if max_workers is None:
+        max_workers = ctx.obj.max_concurrency
+
+    max_workers = max(1, max_workers)
+
+    from . import apitrace
+
+    phase = apitrace.current_phase()
+
+    def scoped(item):
+        with ctx.scope(cleanup=False), apitrace.inherit(phase):
+            return func(item)
+
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for item in items:
+            pending.append(pool.submit(scoped, item))
+
+            if len(pending) >= max_workers * 2:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
 @click.pass_context
 def emit_error(ctx, msg, force=False, color="white", **kwargs):
     '''
@@ -90,6 +231,35 @@ def emit_error(ctx, msg, force=False, color="white", **kwargs):
         click.secho(str(msg), fg=color, err=True, **kwargs)
 
 
+def emit_summary(results):
+    '''
+    results: iterable of tuple(name, result, detail)
+
+    emit one line per result followed by per-result totals
+    '''
+
+    colors = {
+        'failed': 'red',
+        'created': 'green',
+        'updated': 'green',
+        'deleted': 'magenta'
+    }
+    totals = dict()
+
+    for name, result, detail in results:
+        totals[result] = totals.get(result, 0) + 1
+        emit_error(
+            '{}: {}{}'.format(name, result, ' ({})'.format(detail) if detail else ''),
+            force=True,
+            color=colors.get(result, 'white')
+        )
+
+    emit_error(
+        ', '.join('{} {}'.format(v, k) for k, v in sorted(totals.items())) or 'nothing to do',
+        force=True
+    )
+
+
 pretty = PrettyPrinter(depth=20, width=100, indent=4).pformat
 
 
@@ -106,8 +276,29 @@ def get_expiration_time():
 
 @click.pass_context
 def get_eks_token(ctx):
+    '''
+    return: ExecCredential for ctx.params['cluster_name']
+
+    tokens (and any assumed-role credentials behind them) are reused from
+    ctx.obj.credentials until shortly before they expire.  both are keyed
+    by the credentials they were minted with (see credential_identity()),
+    so switching profile or credentials never reuses another identity's
+    '''
+
+    cache_key = (
+        'eks-token',
+        ctx.params['cluster_name'],
+        ctx.params['assume_role'] or '',
+        ctx.obj.mc.region_name or '',
+        credential_identity(ctx.obj.mc)
+    )
 
-    client_factory = STSClientFactory(ctx.obj.mc._session)
+    full_object = ctx.obj.credentials.get(*cache_key)
+
+    if full_object:
+        return full_object
+
+    client_factory = STSClientFactory(ctx.obj.mc._session, ctx.obj.credentials)
 
     sts_client = client_factory.get_sts_client(
         region_name=ctx.obj.mc.region_name,
@@ -130,6 +321,12 @@ def get_eks_token(ctx):
         }
     }
 
+    ctx.obj.credentials.put(
+        full_object,
+        calendar.timegm(time.strptime(token_expiration, '%Y-%m-%dT%H:%M:%SZ')),
+        *cache_key
+    )
+
     return full_object
 
 class TokenGenerator(object):
@@ -153,8 +350,9 @@ class TokenGenerator(object):
 
 
 class STSClientFactory(object):
-    def __init__(self, session):
+    def __init__(self, session, credentials=None):
         self._session = session
+        self._credentials = credentials
 
     def get_sts_client(self, region_name=None, role_arn=None):
         client_kwargs = {
@@ -170,12 +368,28 @@ class STSClientFactory(object):
         return sts
 
     def _get_role_credentials(self, region_name, role_arn):
+        cache_key = (
+            'assumed-role', role_arn, region_name or '',
+            credential_identity(self._session)
+        )
+
+        if self._credentials is not None:
+            creds = self._credentials.get(*cache_key)
+            if creds:
+                return creds
+
         sts = self._session.create_client('sts', region_name)
-        return sts.assume_role(
+        creds = sts.assume_role(
             RoleArn=role_arn,
             RoleSessionName='EKSGetTokenAuth'
         )['Credentials']
 
+        if self._credentials is not None:
+            expiration = creds.pop('Expiration')
+            self._credentials.put(creds, expiration.timestamp(), *cache_key)
+
+        return creds
+
     def _register_cluster_name_handlers(self, sts_client):
         sts_client.meta.events.register(
             'provide-client-params.sts.GetCallerIdentity',
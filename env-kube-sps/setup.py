@@ -8,7 +8,8 @@ setup(
     install_requires=[
         "boto3",
         "kubernetes<20",
-        "Click<8.0.0"
+        "Click<8.0.0",
+        "cryptography"
     ],
     entry_points='''
         [console_scripts]
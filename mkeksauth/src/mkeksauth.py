@@ -9,9 +9,14 @@ import io
 import re
 import selectors
 import copy
-from typing import List, Dict, Any, Tuple, AnyStr
+import contextlib
+import threading
+import time
+from typing import List, Dict, Any, Tuple, AnyStr, Optional
 from kubernetes import client, config  # type: ignore
 import boto3  # type: ignore
+import botocore.session  # type: ignore
+from botocore.config import Config  # type: ignore
 import yaml
 import click
 import json
@@ -33,10 +38,287 @@ DOCUMENT = {
 }
 
 
+THROTTLE_ERROR_CODES = (
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+)
+
+# attempts per AWS call (first try included) before botocore gives up
+RETRY_MAX_ATTEMPTS = 5
+
+# --api-rate <SERVICE>[.<Operation>]=<TPS>
+API_RATE_REX = re.compile(r"^\s*([a-z0-9-]+)(?:\.(\w+))?\s*=\s*(\d+(?:\.\d+)?)\s*$")
+
+
 class CtxObject:
     pass
 
 
+class ApiTrace(object):
+    """
+    ApiTrace()
+
+    Records the latency, retries, throttles and payload size of every AWS
+    (botocore before-call/after-call events) and kubernetes (ApiClient)
+    call, along with per-phase wall time, for `--trace-api`.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phase: Optional[str] = None
+        self.phases: Dict[str, float] = {}
+        self.calls: List[Dict[str, Any]] = []
+
+    @contextlib.contextmanager
+    def timed(self, name: str):
+        previous, self.phase = self.phase, name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase = previous
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def record(self, api: str, operation: str, latency: float, status: int, **kwargs) -> None:
+        self.calls.append(dict(
+            api=api, operation=operation, phase=self.phase, latency=latency,
+            status=status, **dict(dict(retries=0, throttles=0, sent=0, received=0), **kwargs)
+        ))
+
+    def instrument_session(self, session) -> None:
+        session.events.register("before-call", self._before_call)
+        session.events.register("needs-retry", self._needs_retry)
+        session.events.register("after-call", self._after_call)
+
+    @staticmethod
+    def _before_call(params, context, **kwargs) -> None:
+        context["trace"] = {
+            "start": time.perf_counter(),
+            "sent": len(params.get("body") or b""),
+            "throttles": 0,
+        }
+
+    @staticmethod
+    def _needs_retry(response, request_dict, **kwargs) -> None:
+        trace = request_dict.get("context", {}).get("trace")
+        if trace is not None and response:
+            code = response[1].get("Error", {}).get("Code")
+            if code in THROTTLE_ERROR_CODES or response[0].status_code == 429:
+                trace["throttles"] += 1
+
+    def _after_call(self, http_response, parsed, model, context, **kwargs) -> None:
+        trace = context.get("trace")
+        if trace is None:
+            return
+        self.record(
+            "aws",
+            f"{model.service_model.service_id}.{model.name}",
+            time.perf_counter() - trace["start"],
+            http_response.status_code,
+            retries=parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0),
+            throttles=trace["throttles"],
+            sent=trace["sent"],
+            received=len(http_response.content or b""),
+        )
+
+    def instrument_kube(self) -> None:
+        """
+        wrap kubernetes.client.ApiClient.call_api (every API class creates
+        its own default ApiClient)
+        """
+        call_api = getattr(client.ApiClient, "_untraced_call_api", client.ApiClient.call_api)
+        client.ApiClient._untraced_call_api = call_api
+        tracer = self
+
+        def traced_call_api(api_client, resource_path, method, *args, **kwargs):
+            body = kwargs.get("body")
+            start = time.perf_counter()
+            status = 200
+            try:
+                retval = call_api(api_client, resource_path, method, *args, **kwargs)
+            except client.exceptions.ApiException as e:
+                status = e.status or 0
+                raise
+            finally:
+                tracer.record(
+                    "kube",
+                    f"{method} {resource_path}",
+                    time.perf_counter() - start,
+                    status,
+                    throttles=int(status == 429),
+                    sent=len(json.dumps(api_client.sanitize_for_serialization(body)))
+                    if body is not None else 0,
+                )
+            received = retval[0] if isinstance(retval, tuple) else retval
+            tracer.calls[-1]["received"] = len(
+                json.dumps(api_client.sanitize_for_serialization(received))
+            ) if received is not None else 0
+            return retval
+
+        client.ApiClient.call_api = traced_call_api
+
+    def summary(self) -> Dict[str, Any]:
+        operations: Dict[str, Dict[str, Any]] = {}
+
+        for call in self.calls:
+            entry = operations.setdefault(call["operation"], {
+                "api": call["api"], "calls": 0, "errors": 0, "retries": 0,
+                "throttles": 0, "seconds": 0.0, "max": 0.0, "sent": 0,
+                "received": 0, "phases": {},
+            })
+            entry["calls"] += 1
+            entry["errors"] += int(not 200 <= call["status"] < 300)
+            for key in ("retries", "throttles", "sent", "received"):
+                entry[key] += call[key]
+            entry["seconds"] += call["latency"]
+            entry["max"] = max(entry["max"], call["latency"])
+            phase = call["phase"] or "-"
+            entry["phases"][phase] = entry["phases"].get(phase, 0) + 1
+
+        for entry in operations.values():
+            entry["mean"] = entry["seconds"] / entry["calls"]
+
+        return {
+            "elapsed": time.perf_counter() - self.started,
+            "calls": len(self.calls),
+            "retries": sum(el["retries"] for el in self.calls),
+            "throttles": sum(el["throttles"] for el in self.calls),
+            "phases": {
+                name: {
+                    "seconds": seconds,
+                    "calls": len([el for el in self.calls if el["phase"] == name]),
+                }
+                for name, seconds in self.phases.items()
+            },
+            "operations": operations,
+        }
+
+    def emit(self) -> None:
+        click.echo(json.dumps(self.summary(), indent=2, sort_keys=True), err=True)
+
+
+def _tracer() -> Optional[ApiTrace]:
+    ctx = click.get_current_context(silent=True)
+    return ctx.meta.get("trace") if ctx else None
+
+
+def _phase(name: str):
+    tracer = _tracer()
+    return tracer.timed(name) if tracer else contextlib.ExitStack()
+
+
+class TokenBucket(object):
+    """
+    TokenBucket(rate)
+
+    Thread-safe token bucket holding callers to `rate` calls per second;
+    `waited` accumulates the seconds callers were held back.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate)
+        self.waited = 0.0
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+                self.waited += wait
+            time.sleep(wait)
+
+
+class AwsClients(object):
+    """
+    AwsClients(rates)
+
+    The boto3 session of a run.  Every client and resource it creates uses
+    botocore's adaptive retry mode; every attempt, retries included, is held
+    to any `--api-rate` limits (per service, or per service and operation)
+    and throttled responses are counted for report().
+    """
+
+    def __init__(self, rates: Tuple[Tuple[str, Optional[str], float], ...] = ()):
+        self.buckets = {(service, operation): TokenBucket(rate) for service, operation, rate in rates}
+        self.throttles: Dict[str, int] = {}
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            core = botocore.session.get_session()
+            core.set_default_client_config(
+                Config(retries={"mode": "adaptive", "max_attempts": RETRY_MAX_ATTEMPTS})
+            )
+            # first, ahead of any handler that answers the request itself
+            core.get_component("event_emitter").register_first("before-send", self._before_send)
+            core.register("needs-retry", self._needs_retry)
+            self._session = boto3.Session(botocore_session=core)
+
+            tracer = _tracer()
+            if tracer:
+                tracer.instrument_session(self._session)
+
+        return self._session
+
+    def _before_send(self, event_name: str, **kwargs) -> None:
+        # before-send.<service id>.<Operation> fires once per attempt
+        _, service, operation = event_name.split(".", 2)
+        for key in ((service, operation), (service, None)):
+            if key in self.buckets:
+                self.buckets[key].acquire()
+
+    def _needs_retry(self, response, operation, **kwargs) -> None:
+        if not response:
+            return
+        code = response[1].get("Error", {}).get("Code")
+        if code in THROTTLE_ERROR_CODES or response[0].status_code == 429:
+            name = f"{operation.service_model.service_name}.{operation.name}"
+            self.throttles[name] = self.throttles.get(name, 0) + 1
+
+    def report(self) -> None:
+        for name, count in sorted(self.throttles.items()):
+            click.secho(f"{name}: throttled {count} times", err=True, fg="yellow")
+        for (service, operation), bucket in sorted(self.buckets.items(), key=lambda el: str(el[0])):
+            if bucket.waited:
+                name = ".".join(el for el in (service, operation) if el)
+                click.secho(
+                    f"{name}: calls held back {bucket.waited:.1f}s by the {bucket.rate:g} calls/second limit",
+                    err=True,
+                )
+
+
+def _parse_api_rate(ctx, param, value) -> Tuple[Tuple[str, Optional[str], float], ...]:
+    retval = []
+    for el in value:
+        match = API_RATE_REX.match(el)
+        if not match or not float(match.group(3)):
+            raise click.BadParameter("expected <SERVICE>[.<Operation>]=<TPS>")
+        retval.append((match.group(1), match.group(2), float(match.group(3))))
+    return tuple(retval)
+
+
+def _session():
+    """
+    the run's boto3 Session (see AwsClients)
+    """
+    ctx = click.get_current_context(silent=True)
+    if ctx is None:
+        return AwsClients().session
+    return ctx.meta.setdefault("aws", AwsClients()).session
+
+
 class EksAuth(object):
     """
     EksAuth(cluster_name)
@@ -67,24 +349,28 @@ class EksAuth(object):
 
         self.context = context
 
-        try:
-            config.load_kube_config(context=context)
-        except config.ConfigException:
-            raise click.BadParameter(
-                "client configuration for cluster {} not found (~/.kube/config)".format(
-                    cluster_name
-                )  # noqa
-            )
+        with _phase("preflight"):
+            try:
+                config.load_kube_config(context=context)
+            except config.ConfigException:
+                raise click.BadParameter(
+                    "client configuration for cluster {} not found (~/.kube/config)".format(
+                        cluster_name
+                    )  # noqa
+                )
 
-        self._cluster_name = cluster_name
-        self.mc = boto3.Session()
-        yaml.add_representer(str, self._yaml_str_format)
+            self._cluster_name = cluster_name
+            self.mc = _session()
+            yaml.add_representer(str, self._yaml_str_format)
+
+            self._set_cluster_role_arn()
+
+        with _phase("fetch"):
+            self._load_node_role()
+            self._users(user)
+            self._users_from_groups(group)
+            self._build_roles(role)
 
-        self._set_cluster_role_arn()
-        self._load_node_role()
-        self._users(user)
-        self._users_from_groups(group)
-        self._build_roles(role)
         self._doc = copy.deepcopy(DOCUMENT)
 
         self._doc["data"]["mapRoles"] = self._yaml_out(self.roles)  # type: ignore
@@ -102,13 +388,14 @@ class EksAuth(object):
         """
         mc = client.CoreV1Api()
 
-        configmaps = mc.list_namespaced_config_map(namespace).items
-        if "aws-auth" in [el.metadata.name for el in configmaps]:
-            mc.replace_namespaced_config_map(
-                name="aws-auth", body=self._doc, namespace=namespace
-            )
-        else:
-            mc.create_namespaced_config_map(body=self._doc, namespace=namespace)
+        with _phase("write"):
+            configmaps = mc.list_namespaced_config_map(namespace).items
+            if "aws-auth" in [el.metadata.name for el in configmaps]:
+                mc.replace_namespaced_config_map(
+                    name="aws-auth", body=self._doc, namespace=namespace
+                )
+            else:
+                mc.create_namespaced_config_map(body=self._doc, namespace=namespace)
 
     @property
     def cluster_name(self):
@@ -451,8 +738,21 @@ def check_stdin(ctx: click.Context) -> bool:
 @click.option("--verbose", is_flag=True, default=False)
 @click.option("--output-file", type=click.File("w"), default="-")
 @click.option("--apply", is_flag=True, help="Auto-apply aws-auth configmap to cluster")
+@click.option(
+    "--api-rate",
+    multiple=True,
+    callback=_parse_api_rate,
+    metavar="<SERVICE>[.<Operation>]=<TPS>",
+    help="hold AWS calls to a rate (e.g. iam=5)",
+)
+@click.option(
+    "--trace-api",
+    is_flag=True,
+    help="time every AWS/kubernetes API call; JSON summary on stderr",
+)
 @click.pass_context
-def cli(ctx, cluster_name, context, group, user, role, verbose, output_file, apply):
+def cli(ctx, cluster_name, context, group, user, role, verbose, output_file, apply, api_rate,
+        trace_api):
     """
     Create the EKS/aws-auth configmap
 
@@ -467,6 +767,13 @@ def cli(ctx, cluster_name, context, group, user, role, verbose, output_file, app
 
     ctx.obj = CtxObject
 
+    ctx.meta["aws"] = AwsClients(ctx.params.pop("api_rate"))
+    ctx.call_on_close(ctx.meta["aws"].report)
+
+    if ctx.params.pop("trace_api"):
+        ctx.meta["trace"] = ApiTrace()
+        ctx.meta["trace"].instrument_kube()
+        ctx.call_on_close(ctx.meta["trace"].emit)
 
     if check_stdin():
         _ingest_json_config()
@@ -558,7 +865,7 @@ def list_kube_rbac_groups(ctx):
 @click.pass_context
 def list_aws_roles(ctx):
 
-    mc = boto3.Session()
+    mc = _session()
     rc = mc.resource("iam")
 
     _ = [click.echo(role.name) for role in rc.roles.all()]
@@ -568,7 +875,7 @@ def list_aws_roles(ctx):
 @click.pass_context
 def list_aws_users(ctx):
 
-    mc = boto3.Session()
+    mc = _session()
     rc = mc.resource("iam")
 
     _ = [click.echo(user.name) for user in rc.users.all()]
@@ -578,7 +885,7 @@ def list_aws_users(ctx):
 @click.pass_context
 def list_aws_groups(ctx):
 
-    mc = boto3.Session()
+    mc = _session()
     rc = mc.resource("iam")
 
     for group in rc.groups.all():